@@ -0,0 +1,154 @@
+import ast
+import xml.etree.ElementTree as ET
+from typing import List
+
+# builds the same <flowchart> XML that xml_gen asks the model for, straight from the syntax tree
+
+def generate_XML(program_source: str) -> str:
+    tree = ast.parse(program_source)
+
+    statements = tree.body
+    if len(statements) == 1 and isinstance(statements[0], (ast.FunctionDef, ast.AsyncFunctionDef)):
+        statements = statements[0].body
+
+    root = ET.Element("flowchart")
+    add_statements(root, strip_docstring(statements))
+    return ET.tostring(root, "unicode")
+
+def strip_docstring(statements: List[ast.stmt]) -> List[ast.stmt]:
+    if statements and is_docstring(statements[0]):
+        return statements[1:]
+    return statements
+
+def is_docstring(statement: ast.stmt) -> bool:
+    return isinstance(statement, ast.Expr) \
+            and isinstance(statement.value, ast.Constant) \
+            and isinstance(statement.value.value, str)
+
+def add_statements(parent: ET.Element, statements: List[ast.stmt]) -> bool:
+    # returns True if the statements always leave the function
+    for statement in statements:
+        if add_statement(parent, statement):
+            return True
+    return False
+
+def add_branch(parent: ET.Element, tag: str, label: str, statements: List[ast.stmt]) -> ET.Element:
+    branch = ET.SubElement(parent, tag, label=label)
+    add_statements(branch, statements)
+
+    # FlowChart can't lay out empty branches
+    if len(branch) == 0:
+        ET.SubElement(branch, "ProcessBlock", label="pass")
+    return branch
+
+def add_terminator(parent: ET.Element, label: str):
+    ET.SubElement(parent, "DataBlock", label=label)
+    ET.SubElement(parent, "TerminatorBlock", label="Конец")
+
+def add_statement(parent: ET.Element, statement: ast.stmt) -> bool:
+    match statement:
+        case ast.If():
+            decision = ET.SubElement(parent, "DecisionBlock", label=ast.unparse(statement.test))
+            add_branch(decision, "condition", "Истина", statement.body)
+            # elif chains end up as nested decisions in the else branch
+            if statement.orelse:
+                add_branch(decision, "condition", "Иначе", statement.orelse)
+
+        case ast.Match():
+            decision = ET.SubElement(parent, "DecisionBlock", label=ast.unparse(statement.subject))
+            has_default = False
+            for case in statement.cases:
+                is_default = case.guard is None and is_irrefutable(case.pattern)
+                has_default = has_default or is_default
+
+                if is_default and isinstance(case.pattern, ast.MatchAs) and case.pattern.name is None:
+                    label = "Иначе"
+                else:
+                    label = ast.unparse(case.pattern)
+                    if case.guard is not None: label += f" if {ast.unparse(case.guard)}"
+                add_branch(decision, "condition", label, case.body)
+
+            # a single branch already gets an "Иначе" bypass from DecisionBlock
+            if not has_default and len(statement.cases) > 1:
+                add_branch(decision, "condition", "Иначе", [])
+
+        case ast.While():
+            add_branch(parent, "WhileBlock", ast.unparse(statement.test), statement.body)
+            return add_statements(parent, statement.orelse)
+
+        case ast.For() | ast.AsyncFor():
+            label = f"{ast.unparse(statement.target)} in {ast.unparse(statement.iter)}"
+            add_branch(parent, "ForBlock", label, statement.body)
+            return add_statements(parent, statement.orelse)
+
+        case ast.Return():
+            if statement.value is None:
+                ET.SubElement(parent, "TerminatorBlock", label="Конец")
+            else:
+                add_terminator(parent, f"return {ast.unparse(statement.value)}")
+            return True
+
+        case ast.Raise():
+            add_terminator(parent, ast.unparse(statement))
+            return True
+
+        case ast.Try():
+            # GOST has no notation for exception handlers, only the normal path is drawn
+            return add_statements(parent, statement.body + statement.orelse + statement.finalbody)
+
+        case ast.With() | ast.AsyncWith():
+            return add_statements(parent, statement.body)
+
+        case ast.FunctionDef() | ast.AsyncFunctionDef():
+            ET.SubElement(parent, "PreparationBlock", label=f"def {statement.name}")
+
+        case ast.ClassDef():
+            ET.SubElement(parent, "PreparationBlock", label=f"class {statement.name}")
+
+        case ast.Pass():
+            pass
+
+        case ast.Expr() if is_docstring(statement):
+            pass
+
+        case _:
+            ET.SubElement(parent, simple_block_name(statement), label=ast.unparse(statement))
+
+    return False
+
+def is_irrefutable(pattern: ast.pattern) -> bool:
+    match pattern:
+        case ast.MatchAs(pattern=None):
+            return True
+        case ast.MatchAs():
+            return is_irrefutable(pattern.pattern)
+        case ast.MatchOr():
+            return any(is_irrefutable(alternative) for alternative in pattern.patterns)
+    return False
+
+def simple_block_name(statement: ast.stmt) -> str:
+    calls = [node for node in ast.walk(statement) if isinstance(node, ast.Call)]
+    called_names = {call.func.id for call in calls if isinstance(call.func, ast.Name)}
+
+    if "input" in called_names:
+        return "ManualInputBlock"
+    if "print" in called_names:
+        return "DisplayBlock"
+    if calls:
+        return "PredefinedProcessBlock"
+
+    match statement:
+        case ast.Import() | ast.ImportFrom() | ast.Global() | ast.Nonlocal():
+            return "PreparationBlock"
+        case ast.AnnAssign(value=None):
+            return "PreparationBlock"
+        case ast.Assign() | ast.AnnAssign() if is_literal(statement.value):
+            return "PreparationBlock"
+    return "ProcessBlock"
+
+def is_literal(node: ast.expr) -> bool:
+    try:
+        ast.literal_eval(node)
+    except (ValueError, TypeError):
+        return False
+    return True
@@ -0,0 +1,173 @@
+import asyncio
+from abc import ABC, abstractmethod
+import aiohttp
+from typing import AsyncIterator, Callable, Dict, List
+from flowchartron import gpt
+from flowchartron.chat_cache import ChatCacheDB
+
+class RateLimiter:
+    # spaces request starts at least 1/rate seconds apart
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_start = 0.0
+
+    async def wait(self):
+        now = asyncio.get_running_loop().time()
+        delay = self.next_start - now
+        self.next_start = max(now, self.next_start) + self.interval
+        if delay > 0: await asyncio.sleep(delay)
+
+class AsyncChatBackend(ABC):
+    # gpt.ChatBackend for asyncio, many messages can be in flight at once
+    def __init__(self,
+                 model: str,
+                 cache: ChatCacheDB | None = None,
+                 max_concurrency: int = 4,
+                 requests_per_second: float = 2,
+                 timeout: float = 120,
+                 ):
+        self.model = model
+        self.cache = cache
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.limiter = RateLimiter(requests_per_second)
+        self.session: aiohttp.ClientSession | None = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # the session has to be created inside the running loop
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    @abstractmethod
+    def stream_message(self, message: str) -> AsyncIterator[str]:
+        pass
+
+    async def send_message(self,
+                           message: str,
+                           on_partial: Callable[[str], None] | None = None,
+                           stop_when: Callable[[str], bool] | None = None,
+                           use_cache: bool = True,
+                           ) -> str:
+        # use_cache=False always asks the model, a repeated request should not get the same reply back
+        if self.cache is not None and use_cache:
+            cached = self.cache.get_response(self.model, message)
+            if cached is not None:
+                if on_partial is not None: on_partial(cached)
+                return cached
+
+        response_message = ""
+        async with self.semaphore:
+            await self.limiter.wait()
+            stream = self.stream_message(message)
+            try:
+                async for piece in stream:
+                    response_message += piece
+                    if on_partial is not None: on_partial(response_message)
+                    if stop_when is not None and stop_when(response_message): break
+            finally:
+                # closes the response right away when the reply is cut short
+                await stream.aclose()
+
+        if self.cache is not None and response_message != "":
+            self.cache.add_response(self.model, message, response_message)
+        return response_message
+
+class AsyncDuckChat(AsyncChatBackend):
+    # speaks the same protocol as gpt.DuckChat
+    def __init__(self,
+                 cache: ChatCacheDB | None = None,
+                 max_concurrency: int = 4,
+                 requests_per_second: float = 2,
+                 timeout: float = 120,
+                 ):
+        super().__init__(gpt.MODEL, cache, max_concurrency, requests_per_second, timeout)
+        self.url = gpt.CHAT_URL
+        # every reply hands out a token for one more message, /status is asked only when none are left
+        self.tokens: List[str] = []
+
+    async def get_token(self) -> str:
+        if self.tokens:
+            return self.tokens.pop()
+
+        async with self.get_session().get(gpt.STATUS_URL, headers=gpt.STATUS_HEADERS, timeout=self.timeout) as response:
+            response.raise_for_status()
+            return response.headers.get("x-vqd-4", "")
+
+    async def stream_message(self, message: str) -> AsyncIterator[str]:
+        headers = dict(gpt.CHAT_HEADERS)
+        headers["x-vqd-4"] = await self.get_token()
+
+        async with self.get_session().post(
+                self.url,
+                headers=headers,
+                json=gpt.chat_request(self.model, message),
+                timeout=self.timeout
+                ) as response:
+            response.raise_for_status()
+            token = response.headers.get("x-vqd-4", "")
+            if token != "": self.tokens.append(token)
+
+            async for line in response.content:
+                piece = gpt.parse_event(line.rstrip(b"\r\n"))
+                if piece is None: break
+                if piece != "": yield piece
+
+class AsyncOpenAIChat(AsyncChatBackend):
+    # speaks the same protocol as gpt.OpenAIChat
+    def __init__(self,
+                 api_base: str,
+                 api_key: str = "",
+                 model: str = gpt.MODEL,
+                 cache: ChatCacheDB | None = None,
+                 max_concurrency: int = 4,
+                 requests_per_second: float = 2,
+                 timeout: float = 120,
+                 ):
+        super().__init__(model, cache, max_concurrency, requests_per_second, timeout)
+        self.url = api_base.rstrip("/") + "/chat/completions"
+        self.headers = {
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream",
+        }
+        if api_key != "": self.headers["Authorization"] = f"Bearer {api_key}"
+
+    async def stream_message(self, message: str) -> AsyncIterator[str]:
+        data = gpt.chat_request(self.model, message)
+        data["stream"] = True
+
+        async with self.get_session().post(self.url, headers=self.headers, json=data, timeout=self.timeout) as response:
+            response.raise_for_status()
+            async for line in response.content:
+                piece = gpt.parse_openai_event(line.rstrip(b"\r\n"))
+                if piece is None: break
+                if piece != "": yield piece
+
+def make_async_chat(max_concurrency: int = 4, requests_per_second: float = 2, timeout: float = 120, config: Dict[str, str] | None = None) -> AsyncChatBackend:
+    # the asyncio counterpart of gpt.make_chat, configured the same way
+    if config is None: config = gpt.get_config()
+    match config["backend"]:
+        case "duckchat":
+            return AsyncDuckChat(gpt.make_cache(config), max_concurrency, requests_per_second, timeout)
+        case "openai":
+            return AsyncOpenAIChat(
+                    config["api_base"],
+                    config["api_key"],
+                    config["model"],
+                    gpt.make_cache(config),
+                    max_concurrency,
+                    requests_per_second,
+                    timeout
+                    )
+    raise ValueError(f"Unknown chat backend: {config['backend']}")
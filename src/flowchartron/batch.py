@@ -0,0 +1,351 @@
+import argparse, ast, asyncio, json, multiprocessing.util, os, sys, time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+from flowchartron import ast_gen
+from flowchartron.diagramMaker import DrawioDocument, FlowChart
+from flowchartron.elements_db import BlockStyleDB
+from flowchartron.render_cache import CachedExporter, RenderCacheDB, make_render_cache
+
+def extract_functions(source: str) -> List[Tuple[str, int, str]]:
+    # (qualified name, line, source) of every module level function and method
+    tree = ast.parse(source)
+    functions: List[Tuple[str, int, str]] = []
+
+    stack: List[Tuple[str, ast.AST]] = [("", tree)]
+    while stack:
+        prefix, node = stack.pop()
+        for child in reversed(node.body):
+            if isinstance(child, ast.ClassDef):
+                stack.append((f"{prefix}{child.name}.", child))
+            elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                functions.append((f"{prefix}{child.name}", child.lineno, ast.get_source_segment(source, child)))
+
+    functions.reverse()
+    return functions
+
+def get_file_names(functions: List[Tuple[str, int, str]]) -> List[str]:
+    # property getters and setters, overloads and conditional defs share a qualified name, their files get the line too
+    counts = Counter(function_name for function_name, line, function_source in functions)
+    return [
+            function_name if counts[function_name] == 1 else f"{function_name}-L{line}"
+            for function_name, line, function_source in functions
+            ]
+
+def find_sources(source_dir: str, extension: str = ".py") -> List[str]:
+    sources: List[str] = []
+    for dir_path, dir_names, file_names in os.walk(source_dir):
+        dir_names[:] = sorted(d for d in dir_names if not d.startswith("."))
+        for file_name in sorted(file_names):
+            if file_name.endswith(extension):
+                sources.append(os.path.join(dir_path, file_name))
+    return sources
+
+style_db: BlockStyleDB | None = None
+browser = None
+svg_exporter = None
+render_cache: RenderCacheDB | None = None
+
+def init_worker(style_db_path: str, export_png: bool, output_dir: str, renderer: str = "native", export_svg: bool = False, viewer_url: str | None = None):
+    global style_db, browser, svg_exporter, render_cache
+    style_db = BlockStyleDB(style_db_path)
+    # only exports use the cache, it is kept with the output instead of the current directory
+    if export_png or export_svg:
+        render_cache = make_render_cache(os.path.join(output_dir, "render_cache.db"))
+    if export_svg:
+        from flowchartron.renderer import NativeRenderer
+        svg_exporter = NativeRenderer()
+    if export_png and renderer in ("drawio", "drawio-ui"):
+        from flowchartron.chart_gen import DrawIOBrowser, DrawIOScriptBrowser
+        working_directory = os.path.join(output_dir, f".drawio_export_{os.getpid()}")
+        if renderer == "drawio":
+            browser = DrawIOScriptBrowser(working_directory, viewer_url=viewer_url)
+        else:
+            browser = DrawIOBrowser(working_directory)
+        # the browser stays open for all functions of this worker, pool workers exit without running atexit
+        multiprocessing.util.Finalize(browser, browser.close, exitpriority=10)
+    elif export_png:
+        from flowchartron.renderer import NativeRenderer
+        browser = NativeRenderer()
+    # charts that did not change since an earlier run are not exported again
+    if browser is not None and render_cache is not None:
+        browser = CachedExporter(browser, render_cache)
+    if svg_exporter is not None and render_cache is not None:
+        svg_exporter = CachedExporter(svg_exporter, render_cache)
+
+def make_entry(source_path: str, function_name: str | None, generator: str, line: int | None = None) -> dict:
+    return {
+            "source": source_path,
+            "function": function_name,
+            "line": line,
+            "drawio": None,
+            "page": None,
+            "png": None,
+            "svg": None,
+            "status": "ok",
+            "error": None,
+            "generator": generator,
+            "seconds": 0,
+            }
+
+def fail_entry(entry: dict, e: Exception) -> dict:
+    entry["status"] = "failed"
+    entry["error"] = f"{type(e).__name__}: {e}"
+    return entry
+
+async def generate_all_XML(function_sources: List[str], style_db_path: str, single_prompt: bool, concurrency: int, hedge_delay: float | None = None, hedge_attempts: int = 2) -> List[Tuple[str | None, str | None, float]]:
+    # (xml, error, seconds) for every function, the chat requests of all functions run at the same time
+    from flowchartron.async_gpt import make_async_chat
+    from flowchartron.xml_gen import generate_XML_async, generate_XML_hedged
+
+    style_db = BlockStyleDB(style_db_path)
+    async with make_async_chat(concurrency) as chat:
+        async def generate(function_source: str) -> Tuple[str | None, str | None, float]:
+            start = time.perf_counter()
+            try:
+                if hedge_delay is None:
+                    xml = await generate_XML_async(chat, style_db, function_source, single_prompt)
+                else:
+                    xml = await generate_XML_hedged(chat, style_db, function_source, single_prompt, hedge_delay, hedge_attempts)
+            except Exception as e:
+                return None, f"{type(e).__name__}: {e}", time.perf_counter() - start
+            return xml, None, time.perf_counter() - start
+
+        return await asyncio.gather(*(generate(function_source) for function_source in function_sources))
+
+def convert_function(source_path: str, function_name: str, line: int, function_source: str, output_base: str, generator: str, xml: str | None = None, seconds: float = 0) -> dict:
+    # xml is given when the chat model already generated it, seconds is how long that took
+    entry = make_entry(source_path, function_name, generator, line)
+    start = time.perf_counter() - seconds
+
+    try:
+        if xml is None:
+            xml = ast_gen.generate_XML(function_source)
+        flowchart = FlowChart()
+        flowchart.parse_XML(xml, style_db)
+
+        entry["drawio"] = output_base + ".drawio"
+        if browser is None and svg_exporter is None:
+            with open(entry["drawio"], "w", encoding="utf-8") as F:
+                flowchart.chart_compile_to(F, style_db)
+        else:
+            document = flowchart.chart_compile(style_db)
+            with open(entry["drawio"], "w", encoding="utf-8") as F:
+                F.write(document)
+            export_images(entry, document, output_base)
+    except Exception as e:
+        fail_entry(entry, e)
+
+    entry["seconds"] = round(time.perf_counter() - start, 3)
+    return entry
+
+def convert_module(source_path: str, functions: List[Tuple[str, int, str, str, str | None, float]], document_path: str, generator: str) -> List[dict]:
+    # every function becomes a page of one document_path, named like its output base
+    # functions are (function name, line, function source, output base, xml, seconds) as convert_function takes them
+    document = DrawioDocument()
+    # (entry, output base, when it started)
+    pages: List[Tuple[dict, str, float]] = []
+    entries: List[dict] = []
+
+    for function_name, line, function_source, output_base, xml, seconds in functions:
+        entry = make_entry(source_path, function_name, generator, line)
+        entries.append(entry)
+        start = time.perf_counter() - seconds
+        try:
+            if xml is None:
+                xml = ast_gen.generate_XML(function_source)
+            flowchart = FlowChart()
+            flowchart.parse_XML(xml, style_db)
+            document.add_flowchart(os.path.basename(output_base), flowchart, style_db)
+            entry["drawio"] = document_path
+            entry["page"] = len(pages)
+            pages.append((entry, output_base, start))
+        except Exception as e:
+            fail_entry(entry, e)
+        entry["seconds"] = round(time.perf_counter() - start, 3)
+
+    try:
+        xml_document = document.xml_string()
+        with open(document_path, "w", encoding="utf-8") as F:
+            F.write(xml_document)
+    except Exception as e:
+        for entry, output_base, start in pages:
+            entry["drawio"] = None
+            entry["page"] = None
+            fail_entry(entry, e)
+        return entries
+
+    # the images are still one per function, every page is exported from the same document
+    for entry, output_base, start in pages:
+        try:
+            export_images(entry, xml_document, output_base, entry["page"])
+        except Exception as e:
+            fail_entry(entry, e)
+        entry["seconds"] = round(time.perf_counter() - start, 3)
+
+    return entries
+
+def export_images(entry: dict, document: str, output_base: str, page: int = 0):
+    if browser is not None:
+        entry["png"] = output_base + ".png"
+        with open(entry["png"], "wb") as F:
+            F.write(browser.export_diagram(document, "png", page=page))
+    if svg_exporter is not None:
+        entry["svg"] = output_base + ".svg"
+        with open(entry["svg"], "wb") as F:
+            F.write(svg_exporter.export_diagram(document, "svg", page=page))
+
+def run_batch(source_dir: str, output_dir: str, jobs: int | None = None, export_png: bool = False, generator: str = "ast", concurrency: int = 4, hedge_delay: float | None = None, hedge_attempts: int = 2, renderer: str = "native", export_svg: bool = False, viewer_url: str | None = None, pages: bool = False) -> List[dict]:
+    os.makedirs(output_dir, exist_ok=True)
+    style_db_path = os.path.join(output_dir, "styles.db")
+    # create the default styles once, before the workers open the file concurrently
+    BlockStyleDB(style_db_path).con.close()
+
+    manifest: List[dict] = []
+    # (source, function name, line, function source, output base)
+    tasks: List[Tuple[str, str, int, str, str]] = []
+    for source_path in find_sources(source_dir):
+        relative_path = os.path.relpath(source_path, source_dir)
+        module_dir = os.path.join(output_dir, os.path.splitext(relative_path)[0])
+
+        try:
+            with open(source_path, encoding="utf-8") as F:
+                functions = extract_functions(F.read())
+        except (SyntaxError, UnicodeDecodeError) as e:
+            manifest.append(fail_entry(make_entry(relative_path, None, generator), e))
+            continue
+
+        # with pages the module is one .drawio next to module_dir, which only holds the images
+        if functions and (not pages or export_png or export_svg):
+            os.makedirs(module_dir, exist_ok=True)
+        elif functions:
+            os.makedirs(os.path.dirname(module_dir), exist_ok=True)
+        for (function_name, line, function_source), file_name in zip(functions, get_file_names(functions)):
+            tasks.append((relative_path, function_name, line, function_source, os.path.join(module_dir, file_name)))
+
+    # chat requests are network bound, they run concurrently here and the workers only lay the charts out
+    generated: List[Tuple[str | None, str | None, float]] = [(None, None, 0)] * len(tasks)
+    if generator != "ast":
+        generated = asyncio.run(generate_all_XML(
+            [task[3] for task in tasks],
+            style_db_path,
+            generator == "gpt-single",
+            concurrency,
+            hedge_delay,
+            hedge_attempts
+            ))
+
+    with ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=init_worker,
+            initargs=(style_db_path, export_png, output_dir, renderer, export_svg, viewer_url)
+            ) as executor:
+        futures = []
+        # source -> what convert_module takes for each of its functions
+        modules: Dict[str, List[Tuple[str, int, str, str, str | None, float]]] = {}
+        for (relative_path, function_name, line, function_source, output_base), (xml, error, seconds) in zip(tasks, generated):
+            if error is not None:
+                entry = make_entry(relative_path, function_name, generator, line)
+                entry["status"] = "failed"
+                entry["error"] = error
+                entry["seconds"] = round(seconds, 3)
+                manifest.append(entry)
+                print(f"[failed] {relative_path}: {function_name}", file=sys.stderr)
+                continue
+
+            if pages:
+                modules.setdefault(relative_path, []).append((function_name, line, function_source, output_base, xml, seconds))
+                continue
+
+            futures.append(executor.submit(
+                convert_function,
+                relative_path,
+                function_name,
+                line,
+                function_source,
+                output_base,
+                generator,
+                xml,
+                seconds
+                ))
+
+        for relative_path, functions in modules.items():
+            document_path = os.path.join(output_dir, os.path.splitext(relative_path)[0] + ".drawio")
+            futures.append(executor.submit(convert_module, relative_path, functions, document_path, generator))
+
+        for future in as_completed(futures):
+            entries = future.result()
+            # convert_module converts a whole module at once
+            if isinstance(entries, dict): entries = [entries]
+            for entry in entries:
+                for key in ("drawio", "png", "svg"):
+                    if entry[key] is not None: entry[key] = os.path.relpath(entry[key], output_dir)
+                print(f"[{entry['status']}] {entry['source']}: {entry['function']}", file=sys.stderr)
+                manifest.append(entry)
+
+    manifest.sort(key=lambda entry: (entry["source"], entry["line"] or 0))
+    with open(os.path.join(output_dir, "manifest.json"), "w", encoding="utf-8") as F:
+        json.dump(manifest, F, ensure_ascii=False, indent=2)
+
+    return manifest
+
+def batch_main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+            prog="flowchartron batch",
+            description="Generate flowcharts for every function in a source tree without the GUI."
+            )
+    parser.add_argument("source_dir", help="directory to search for .py files")
+    parser.add_argument("-o", "--output", default="flowcharts", help="output directory (default: flowcharts)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument(
+            "-g", "--generator",
+            choices=["ast", "gpt", "gpt-single"],
+            default="ast",
+            help="ast builds the chart from the syntax tree locally, gpt asks the chat model in three steps, gpt-single in one request (default: ast)"
+            )
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="chat requests in flight at once for the gpt generators (default: 4)")
+    parser.add_argument(
+            "--hedge",
+            type=float,
+            default=None,
+            metavar="SECONDS",
+            help="start a duplicate chat request for a function that has not produced valid XML after SECONDS, 0 starts them all at once"
+            )
+    parser.add_argument("--hedge-attempts", type=int, default=2, help="how many requests --hedge may run for one function (default: 2)")
+    parser.add_argument("--pages", action="store_true", help="write one .drawio per module with a page for every function instead of a file per function")
+    parser.add_argument("--png", action="store_true", help="also export every chart to PNG")
+    parser.add_argument("--svg", action="store_true", help="also export every chart to SVG")
+    parser.add_argument(
+            "--renderer",
+            choices=["native", "drawio", "drawio-ui"],
+            default="native",
+            help="native draws the PNG locally, drawio renders it with draw.io's viewer in a headless browser, drawio-ui clicks through the draw.io editor (default: native)"
+            )
+    parser.add_argument(
+            "--drawio-viewer",
+            default=None,
+            metavar="URL_OR_PATH",
+            help="where --renderer drawio loads draw.io's viewer-static.min.js from, a URL or a local file (default: $FLOWCHARTRON_DRAWIO_VIEWER or viewer.diagrams.net)"
+            )
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.source_dir):
+        parser.error(f"{args.source_dir} is not a directory")
+
+    manifest = run_batch(
+            args.source_dir,
+            args.output,
+            args.jobs,
+            args.png,
+            args.generator,
+            args.concurrency,
+            args.hedge,
+            args.hedge_attempts,
+            args.renderer,
+            args.svg,
+            args.drawio_viewer,
+            args.pages
+            )
+    failed = sum(1 for entry in manifest if entry["status"] != "ok")
+    print(f"{len(manifest) - failed} converted, {failed} failed, manifest: {os.path.join(args.output, 'manifest.json')}", file=sys.stderr)
+    return 1 if failed else 0
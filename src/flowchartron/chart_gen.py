@@ -1,74 +1,208 @@
-import os, shutil, time
+import base64, ctypes, ctypes.util, os, queue, select, shutil, sys, tempfile, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from PyQt5.QtCore import pyqtSignal 
+from flowchartron.diagramMaker import extract_page
 
-def cp(file_path: str, output_path: str):
-    if os.name == "nt":
-        cmd = f"copy \"{file_path}\" \"{output_path}\""
-    else:
-        cmd = f"cp \"{file_path}\" \"{output_path}\""
-    os.system(cmd)
+# browsers write a download next to its final name and rename it when done
+PARTIAL_SUFFIXES = (".part", ".crdownload")
+POLL_INTERVAL = 0.05
+
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+class DirectoryWatcher:
+    # wakes up whenever a file in directory is written, renamed or removed, through Linux inotify
+    def __init__(self, directory: str):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        # IN_NONBLOCK and IN_CLOEXEC have the values of O_NONBLOCK and O_CLOEXEC
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}")
+
+    def wait(self, timeout: float):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready: return
+        # what changed does not matter, the caller looks at the files again
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+def make_watcher(directory: str) -> DirectoryWatcher | None:
+    if not sys.platform.startswith("linux"): return None
+    try:
+        return DirectoryWatcher(directory)
+    except (OSError, AttributeError):
+        # no inotify (or out of watches), wait_for_download polls instead
+        return None
+
+def download_finished(path: str) -> bool:
+    # Firefox creates an empty placeholder first and renames the .part file over it at the end
+    if not os.path.isfile(path) or os.path.getsize(path) == 0: return False
+    return not any(os.path.exists(path + suffix) for suffix in PARTIAL_SUFFIXES)
+
+def clear_directory(directory: str):
+    # leftovers of an earlier export, placeholders and .part files included
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path): os.remove(path)
+
+def wait_for_download(path: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    # watching starts before the first look, so a download finishing in between is not missed
+    watcher = make_watcher(os.path.dirname(path))
+    try:
+        while not download_finished(path):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"The download of {path} did not finish within {timeout:g} s")
+            if watcher is not None:
+                watcher.wait(remaining)
+            else:
+                time.sleep(min(POLL_INTERVAL, remaining))
+    finally:
+        if watcher is not None: watcher.close()
+
+class NullSignal:
+    # export_to_png reports its steps, export_diagram has nobody to report them to
+    def emit(self, value: int):
+        pass
+
+class RenderError(RuntimeError):
+    # draw.io refused the diagram, the browser itself is fine
+    pass
 
 class DrawIOBrowser:
-    def __init__(self):
-        if not os.path.exists(".drawio_export"):
-            os.makedirs(".drawio_export")
-        if not os.path.isdir(".drawio_export"):
+    # keeps up to pool_size headless Firefox instances open on a blank diagram, every export
+    # borrows one and blanks it again afterwards, so exports from several threads run in parallel
+    def __init__(self, working_directory: str = ".drawio_export", pool_size: int = 1, download_timeout: float = 60):
+        if not os.path.exists(working_directory):
+            os.makedirs(working_directory)
+        if not os.path.isdir(working_directory):
             raise IsADirectoryError
-        self._WORKING_DIRECTORY = os.path.abspath(".drawio_export")
+        self._WORKING_DIRECTORY = os.path.abspath(working_directory)
+        self.pool_size = max(1, pool_size)
+        self.download_timeout = download_timeout
 
-    def export_to_png(self, drawio_file: str, output_path: str, progress_signal: pyqtSignal):
+        # (driver, its download directory)
+        self._idle: queue.Queue[Tuple[webdriver.Firefox, str]] = queue.Queue()
+        self._drivers: List[webdriver.Firefox] = []
+        self._started = 0
+        self._driver_number = 0
+        self._lock = threading.Lock()
+
+    def _start_driver(self, download_dir: str) -> webdriver.Firefox:
         options = webdriver.FirefoxOptions()
         options.set_preference("browser.download.folderList", 2)
         options.set_preference("browser.download.manager.showWhenStarting", 2)
         options.set_preference("browser.download.folderList", 2)
-        options.set_preference("browser.download.dir", self._WORKING_DIRECTORY)
+        options.set_preference("browser.download.dir", download_dir)
         options.add_argument("-headless")
 
-        progress_signal.emit(1)
-        self._driver = webdriver.Firefox(options=options)
-        self._driver.implicitly_wait(10)
-        self._driver.get("https://app.diagrams.net/")
+        driver = webdriver.Firefox(options=options)
+        try:
+            driver.implicitly_wait(10)
+            driver.get("https://app.diagrams.net/")
 
-        save_to_device_btn = self._driver.find_element(
-                By.XPATH,
-                "/html/body/div[11]/div/div/div/a[3]"
-                )
-        save_to_device_btn.click()
+            save_to_device_btn = driver.find_element(
+                    By.XPATH,
+                    "/html/body/div[11]/div/div/div/a[3]"
+                    )
+            save_to_device_btn.click()
 
-        new_diagram_btn = self._driver.find_element(
-                By.CSS_SELECTOR, 
-                "button.geBigButton:nth-child(1)"
-                )
-        new_diagram_btn.click()
+            new_diagram_btn = driver.find_element(
+                    By.CSS_SELECTOR, 
+                    "button.geBigButton:nth-child(1)"
+                    )
+            new_diagram_btn.click()
 
-        filename_textbox = self._driver.find_element(
-                By.CSS_SELECTOR, 
-                ".geDialog > div:nth-child(1) > div:nth-child(1) > input:nth-child(2)"
-                )
-        filename_textbox.clear()
-        filename_textbox.send_keys("output.png")
+            filename_textbox = driver.find_element(
+                    By.CSS_SELECTOR, 
+                    ".geDialog > div:nth-child(1) > div:nth-child(1) > input:nth-child(2)"
+                    )
+            filename_textbox.clear()
+            filename_textbox.send_keys("output.png")
 
-        create_btn = self._driver.find_element(
-                By.CSS_SELECTOR, 
-                "button.geBtn:nth-child(4)"
-                )
-        create_btn.click()
+            create_btn = driver.find_element(
+                    By.CSS_SELECTOR, 
+                    "button.geBtn:nth-child(4)"
+                    )
+            create_btn.click()
+        except:
+            driver.quit()
+            raise
+        return driver
 
-        if not os.path.exists(drawio_file):
-            raise FileNotFoundError
-        if os.path.isdir(output_path):
-            output_path = os.path.join(output_path, "output.png")
+    def warm_up(self, count: int | None = None):
+        # starts the drivers ahead of the first exports instead of during them
+        count = self.pool_size if count is None else min(count, self.pool_size)
+        drivers = [self._checkout() for _ in range(count)]
+        for driver, download_dir in drivers:
+            self._idle.put((driver, download_dir))
 
-        drawio_file = os.path.abspath(drawio_file)
+    def _checkout(self) -> Tuple[webdriver.Firefox, str]:
+        while True:
+            with self._lock:
+                try:
+                    return self._idle.get_nowait()
+                except queue.Empty:
+                    pass
+                if self._started < self.pool_size:
+                    self._started += 1
+                    self._driver_number += 1
+                    download_dir = os.path.join(self._WORKING_DIRECTORY, f"driver_{self._driver_number}")
+                    break
+            # a driver that breaks is not returned, so look again for a free slot now and then
+            try:
+                return self._idle.get(timeout=1)
+            except queue.Empty:
+                pass
 
-        downloaded_path = os.path.join(self._WORKING_DIRECTORY, "output.png")
-        if os.path.isfile(downloaded_path): os.remove(downloaded_path)
+        try:
+            os.makedirs(download_dir, exist_ok=True)
+            driver = self._start_driver(download_dir)
+        except:
+            with self._lock:
+                self._started -= 1
+            raise
 
-        progress_signal.emit(2)
-        webdriver.ActionChains(self._driver)\
+        with self._lock:
+            self._drivers.append(driver)
+        return driver, download_dir
+
+    def _checkin(self, driver: webdriver.Firefox, download_dir: str, healthy: bool):
+        with self._lock:
+            # the pool may have been closed while the driver was out
+            healthy = healthy and driver in self._drivers
+        if healthy:
+            try:
+                self._reset(driver, download_dir)
+                self._idle.put((driver, download_dir))
+                return
+            except:
+                pass
+        self._discard(driver)
+
+    def _reset(self, driver: webdriver.Firefox, download_dir: str):
+        # back to the blank diagram the driver was started on
+        webdriver.ActionChains(driver)\
                 .key_down(Keys.CONTROL)\
                 .send_keys("a")\
                 .key_up(Keys.CONTROL)\
@@ -76,46 +210,299 @@ class DrawIOBrowser:
                 .key_down(Keys.DELETE)\
                 .perform()
 
-        scratchpad_btn = self._driver.find_element(
+        clear_directory(download_dir)
+
+    def _discard(self, driver: webdriver.Firefox):
+        with self._lock:
+            if driver in self._drivers:
+                self._drivers.remove(driver)
+                self._started -= 1
+        try:
+            driver.quit()
+        except:
+            pass
+
+    def export_to_png(self, drawio_file: str, output_path: str, progress_signal: pyqtSignal):
+        if not os.path.exists(drawio_file):
+            raise FileNotFoundError
+        if os.path.isdir(output_path):
+            output_path = os.path.join(output_path, "output.png")
+
+        drawio_file = os.path.abspath(drawio_file)
+
+        progress_signal.emit(1)
+        driver, download_dir = self._checkout()
+        healthy = False
+        try:
+            self._export(driver, download_dir, drawio_file, output_path, progress_signal)
+            healthy = True
+        except RenderError:
+            healthy = True
+            raise
+        finally:
+            # a driver that failed mid-export may be stuck in a dialog, a fresh one replaces it
+            self._checkin(driver, download_dir, healthy)
+
+    def export_diagram(self, xml: str, format: str = "png", page: int = 0) -> bytes:
+        # the editor only opens files, so the diagram and the image go through the working directory,
+        # and it imports every page of a file at once, so the file only gets the one to export
+        if format != "png":
+            raise ValueError(f"The draw.io editor only exports PNG, not {format}")
+
+        file_descriptor, drawio_file = tempfile.mkstemp(".drawio", dir=self._WORKING_DIRECTORY)
+        output_path = drawio_file[:-len(".drawio")] + ".png"
+        try:
+            with os.fdopen(file_descriptor, "w", encoding="utf-8") as F:
+                F.write(extract_page(xml, page))
+            self.export_to_png(drawio_file, output_path, NullSignal())
+            with open(output_path, "rb") as F:
+                return F.read()
+        finally:
+            for path in (drawio_file, output_path):
+                if os.path.exists(path): os.remove(path)
+
+    def _export(self, driver: webdriver.Firefox, download_dir: str, drawio_file: str, output_path: str, progress_signal: pyqtSignal):
+        clear_directory(download_dir)
+        downloaded_path = os.path.join(download_dir, "output.png")
+
+        progress_signal.emit(2)
+        scratchpad_btn = driver.find_element(
                 By.CSS_SELECTOR, 
                 "img.geAdaptiveAsset:nth-child(3)"
                 )
         scratchpad_btn.click()
 
-        file_input = self._driver.find_element(
+        file_input = driver.find_element(
                 By.CSS_SELECTOR, 
                 "input[type=file]"
                 )
         file_input.send_keys(drawio_file)
 
-        save_btn = self._driver.find_element(
+        save_btn = driver.find_element(
                 By.CSS_SELECTOR, 
                 "#btnSave"
                 )
         save_btn.click()
 
-        last_scratchpad_elem = self._driver.find_element(
+        last_scratchpad_elem = driver.find_element(
                 By.CSS_SELECTOR, 
                 "div.geSidebarContainer:nth-child(5) > div:nth-child(1) > div:nth-child(4) > div:nth-child(1) > a:last-child"
                 )
         last_scratchpad_elem.click()
 
         progress_signal.emit(3)
-        webdriver.ActionChains(self._driver)\
+        webdriver.ActionChains(driver)\
                 .key_down(Keys.CONTROL)\
                 .send_keys("s")\
                 .key_up(Keys.CONTROL)\
                 .perform()
 
-        while not os.path.isfile(downloaded_path):
-            time.sleep(0.5)
+        # a timeout fails the export and discards the driver together with its download directory,
+        # so a late download never shows up in another export
+        wait_for_download(downloaded_path, self.download_timeout)
+        shutil.move(downloaded_path, output_path)
 
-        cp(downloaded_path, output_path)
-        self._driver.quit()
+    def close(self):
+        with self._lock:
+            drivers = self._drivers
+            self._drivers = []
+            self._started = 0
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                break
+        for driver in drivers:
+            try:
+                driver.quit()
+            except:
+                pass
 
     def __del__(self):
+        if hasattr(self, "_drivers"):
+            self.close()
         if os.path.isdir(self._WORKING_DIRECTORY):
             shutil.rmtree(self._WORKING_DIRECTORY)
-        self._driver.quit()
         return
 
+VIEWER_URL = "https://viewer.diagrams.net/js/viewer-static.min.js"
+
+def get_viewer_url() -> str:
+    # a URL or the path of a local viewer-static.min.js, for machines that can't reach the CDN
+    return os.environ.get("FLOWCHARTRON_DRAWIO_VIEWER", "") or VIEWER_URL
+
+# renderDiagram(xml, format, scale, page) draws a page of an mxfile with draw.io's own viewer and resolves to a data URL,
+# labels are plain SVG text (no foreignObject) so the PNG canvas can be read back
+VIEWER_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<script src="{viewer_src}"></script>
+<script>
+mxClient.NO_FO = true;
+
+function toDataURL(svg) {{
+    return "data:image/svg+xml;base64," + btoa(unescape(encodeURIComponent(svg)));
+}}
+
+function renderDiagram(xml, format, scale, page) {{
+    return new Promise(function (resolve, reject) {{
+        var node = mxUtils.parseXml(xml).documentElement;
+        if (page >= Math.max(1, node.getElementsByTagName("diagram").length)) {{
+            reject(new Error("the diagram has no page " + page));
+            return;
+        }}
+        var container = document.createElement("div");
+        document.body.appendChild(container);
+        var svg;
+        try {{
+            var viewer = new GraphViewer(container, node, {{"nav": false, "resize": false, "page": page}});
+            svg = mxUtils.getXml(viewer.graph.getSvg("#ffffff", scale, 10));
+        }} catch (e) {{
+            reject(e);
+            return;
+        }} finally {{
+            container.remove();
+        }}
+
+        if (format == "svg") {{
+            resolve(toDataURL(svg));
+            return;
+        }}
+        var image = new Image();
+        image.onload = function () {{
+            var canvas = document.createElement("canvas");
+            canvas.width = image.width;
+            canvas.height = image.height;
+            var context = canvas.getContext("2d");
+            context.fillStyle = "#ffffff";
+            context.fillRect(0, 0, canvas.width, canvas.height);
+            context.drawImage(image, 0, 0);
+            resolve(canvas.toDataURL("image/png"));
+        }};
+        image.onerror = function () {{
+            reject(new Error("the exported SVG could not be drawn"));
+        }};
+        image.src = toDataURL(svg);
+    }});
+}}
+</script>
+</head>
+<body></body>
+</html>
+"""
+
+RENDER_SCRIPT = """
+var done = arguments[arguments.length - 1];
+renderDiagram(arguments[0], arguments[1], arguments[2], arguments[3]).then(done, function (e) { done("error:" + e); });
+"""
+
+class ViewerPageServer(ThreadingHTTPServer):
+    # serves the render page on localhost, and the viewer script too when it is a local file
+    daemon_threads = True
+
+    def __init__(self, viewer_url: str):
+        super().__init__(("127.0.0.1", 0), ViewerPageHandler)
+        self.viewer_file = viewer_url if os.path.isfile(viewer_url) else None
+        viewer_src = "/viewer.js" if self.viewer_file is not None else viewer_url
+        self.page = VIEWER_PAGE.format(viewer_src=viewer_src.replace('"', "%22")).encode("utf-8")
+
+    def get_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/"
+
+class ViewerPageHandler(BaseHTTPRequestHandler):
+    server: ViewerPageServer
+
+    def do_GET(self):
+        if self.path == "/":
+            self.send_body(self.server.page, "text/html; charset=utf-8")
+        elif self.path == "/viewer.js" and self.server.viewer_file is not None:
+            with open(self.server.viewer_file, "rb") as F:
+                self.send_body(F.read(), "application/javascript")
+        else:
+            self.send_error(404)
+
+    def send_body(self, data: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args):
+        pass
+
+class DrawIOScriptBrowser(DrawIOBrowser):
+    # renders through draw.io's JavaScript viewer instead of clicking through the editor:
+    # the XML goes in with execute_script and the image comes back as a data URL,
+    # no dialogs, no scratchpad and no downloads folder
+    def __init__(self, working_directory: str = ".drawio_export", pool_size: int = 1, timeout: float = 60, viewer_url: str | None = None):
+        super().__init__(working_directory, pool_size, timeout)
+        self.viewer_url = get_viewer_url() if viewer_url is None else viewer_url
+        self._server: ViewerPageServer | None = None
+
+    def _get_page_url(self) -> str:
+        with self._lock:
+            if self._server is None:
+                self._server = ViewerPageServer(self.viewer_url)
+                threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            return self._server.get_url()
+
+    def _start_driver(self, download_dir: str) -> webdriver.Firefox:
+        options = webdriver.FirefoxOptions()
+        options.add_argument("-headless")
+
+        driver = webdriver.Firefox(options=options)
+        try:
+            driver.set_script_timeout(self.download_timeout)
+            driver.get(self._get_page_url())
+            if not driver.execute_script("return typeof GraphViewer == 'function' && typeof renderDiagram == 'function'"):
+                raise RuntimeError(f"The draw.io viewer could not be loaded from {self.viewer_url}")
+        except:
+            driver.quit()
+            raise
+        return driver
+
+    def _reset(self, driver: webdriver.Firefox, download_dir: str):
+        # every render removes its own container, the page stays blank
+        pass
+
+    def _render(self, driver: webdriver.Firefox, xml: str, format: str, scale: float, page: int = 0) -> bytes:
+        data_url = driver.execute_async_script(RENDER_SCRIPT, xml, format, scale, page)
+        if not isinstance(data_url, str) or not data_url.startswith("data:"):
+            raise RenderError(f"draw.io could not render the diagram: {data_url}")
+        return base64.b64decode(data_url.partition(",")[2])
+
+    def export_diagram(self, xml: str, format: str = "png", page: int = 0, scale: float = 1) -> bytes:
+        # xml is a .drawio document like FlowChart.chart_compile returns, format is png or svg
+        driver, download_dir = self._checkout()
+        healthy = False
+        try:
+            data = self._render(driver, xml, format, scale, page)
+            healthy = True
+        except RenderError:
+            healthy = True
+            raise
+        finally:
+            self._checkin(driver, download_dir, healthy)
+        return data
+
+    def _export(self, driver: webdriver.Firefox, download_dir: str, drawio_file: str, output_path: str, progress_signal: pyqtSignal):
+        with open(drawio_file, encoding="utf-8") as F:
+            xml = F.read()
+
+        progress_signal.emit(2)
+        data = self._render(driver, xml, "png", 1)
+
+        progress_signal.emit(3)
+        with open(output_path, "wb") as F:
+            F.write(data)
+
+    def close(self):
+        super().close()
+        with self._lock:
+            server = self._server
+            self._server = None
+        if server is not None:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,71 @@
+import hashlib, sqlite3, time
+
+def evict_lru(cur: sqlite3.Cursor, table: str, max_bytes: int):
+    # drops the least recently used rows of table until their size column adds up to max_bytes at most
+    cur.execute(f'''SELECT COALESCE(SUM(size), 0) FROM {table}''')
+    total = cur.fetchone()[0]
+    if total <= max_bytes: return
+
+    stale_keys = []
+    for key, size in cur.execute(f'''SELECT key, size FROM {table} ORDER BY last_used''').fetchall():
+        if total <= max_bytes: break
+        stale_keys.append((key,))
+        total -= size
+    cur.executemany(f'''DELETE FROM {table} WHERE key = ?''', stale_keys)
+
+class ChatCacheDB:
+    def __init__(self, file_name: str, max_bytes: int = 64 * 1024 * 1024, ttl: float | None = None):
+        self.con = sqlite3.connect(file_name, timeout=30)
+        self.cur = self.con.cursor()
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self.cur.execute(f'''CREATE TABLE IF NOT EXISTS RESPONSES (key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, created REAL, last_used REAL)''')
+        self.cur.execute(f'''CREATE INDEX IF NOT EXISTS RESPONSES_LAST_USED ON RESPONSES (last_used)''')
+        self.con.commit()
+
+    def __del__(self):
+        self.con.close()
+
+    @staticmethod
+    def get_key(model: str, prompt: str) -> str:
+        return hashlib.sha256(f"{model}\0{prompt}".encode("utf-8")).hexdigest()
+
+    def get_response(self, model: str, prompt: str) -> str | None:
+        key = self.get_key(model, prompt)
+        self.cur.execute(f'''SELECT response, created FROM RESPONSES WHERE key = ?''', (key,))
+        row = self.cur.fetchone()
+
+        now = time.time()
+        if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+            self.cur.execute(f'''DELETE FROM RESPONSES WHERE key = ?''', (key,))
+            self.con.commit()
+            row = None
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.cur.execute(f'''UPDATE RESPONSES SET last_used = ? WHERE key = ?''', (now, key))
+        self.con.commit()
+        self.hits += 1
+        return row[0]
+
+    def add_response(self, model: str, prompt: str, response: str):
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        self.cur.execute(
+                f'''INSERT OR REPLACE INTO RESPONSES (key, model, response, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?)''',
+                (self.get_key(model, prompt), model, response, size, now, now)
+                )
+        self.evict()
+        self.con.commit()
+
+    def evict(self):
+        evict_lru(self.cur, "RESPONSES", self.max_bytes)
+
+    def clear(self):
+        self.cur.execute(f'''DELETE FROM RESPONSES''')
+        self.con.commit()
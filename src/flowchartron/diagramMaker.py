@@ -1,6 +1,8 @@
+import base64, io, zlib
+from urllib.parse import quote, unquote
 from abc import ABC, abstractmethod
-from typing import List, Tuple
-from bs4 import BeautifulSoup
+from functools import lru_cache, partial
+from typing import Any, Callable, Generator, Iterator, List, Mapping, TextIO, Tuple
 import xml.etree.ElementTree as ET
 from flowchartron.elements_db import BlockStyle, BlockStyleDB
 
@@ -14,8 +16,50 @@ class IDIterator:
         self.a += 1
         return x
 
-iteratorInstance = IDIterator()
-blockID = iter(iteratorInstance)
+# compile_steps() generators yield the steps of their children and receive
+# back the position where the child ended
+CompileSteps = Generator[Any, Tuple[int, int], Tuple[int, int]]
+
+def run_steps(steps: CompileSteps) -> Tuple[int, int]:
+    # drives nested compile_steps() with an explicit stack instead of recursion
+    stack: List[CompileSteps] = [steps]
+    pos = None
+    while stack:
+        try:
+            child = stack[-1].send(pos)
+        except StopIteration as stop:
+            stack.pop()
+            pos = stop.value
+            continue
+        stack.append(child)
+        pos = None
+    return pos
+
+def measure_subtree(node: "SubChart | Element"):
+    # post-order walk, so every node is measured after its children
+    stack: List[Tuple[SubChart | Element, bool]] = [(node, False)]
+    while stack:
+        node, children_measured = stack.pop()
+        if children_measured:
+            node._metrics = node.measure()
+            continue
+        stack.append((node, True))
+        for child in node.get_children():
+            stack.append((child, False))
+
+def invalidate_upwards(node: "SubChart | Element | None"):
+    # a node is measured from its children, so everything above a change is stale too
+    while node is not None:
+        node._metrics = None
+        node = node._owner
+
+def assign_subtree_ids(node: "SubChart | Element", drawio_flowchart: "CellSink"):
+    # pre-order walk, the same tree always gets the same ids
+    stack: List[SubChart | Element] = [node]
+    while stack:
+        node = stack.pop()
+        node.assign_ids(drawio_flowchart)
+        stack.extend(reversed(node.get_children()))
 
 class FlowChart:
     def __init__(self):
@@ -35,41 +79,106 @@ class FlowChart:
     def __parse_XML_subChart__(self, root: ET.Element, style_db: BlockStyleDB) -> "SubChart":
         subChart = SubChart()
 
-        for element in root:
+        # every frame walks the children of one XML node into its target,
+        # on_done attaches the finished target to its parent
+        stack: List[Tuple[Iterator[ET.Element], SubChart | DecisionBlock, Callable[[], None] | None]] = [
+                (iter(root), subChart, None)
+                ]
+
+        while stack:
+            children, target, on_done = stack[-1]
+            element = next(children, None)
+
+            if element is None:
+                stack.pop()
+                if on_done is not None: on_done()
+                continue
+
+            if isinstance(target, DecisionBlock):
+                decision = Decision(element.attrib['label'])
+                stack.append((iter(element), decision.subChart, partial(target.add_decision, decision)))
+                continue
+
             style_dict = style_db.get_styles(element.tag)
             behaviour_type = list(style_dict.values())[0]._behaviour_type
 
             match behaviour_type:
                 case 'BasicBlock':
-                    subChart.add_element(BasicBlock(element.attrib['label'], style_dict))
+                    target.add_element(BasicBlock(element.attrib['label'], style_dict))
 
                 case 'DecisionBlock':
                     decision_block = DecisionBlock(element.attrib['label'], style_dict)
-                    for condition in element:
-                        decision = Decision(condition.attrib['label'])
-                        decision.subChart = self.__parse_XML_subChart__(condition, style_db)
-                        decision_block.add_decision(decision)
-                    subChart.add_element(decision_block)
+                    stack.append((iter(element), decision_block, partial(target.add_element, decision_block)))
 
                 case 'WhileBlock':
                     style_dict = style_db.get_styles("WhileBlock")
                     while_block = WhileBlock(element.attrib['label'], style_dict)
-                    while_block.subChart = self.__parse_XML_subChart__(element, style_db)
-                    subChart.add_element(while_block)
+                    stack.append((iter(element), while_block.subChart, partial(target.add_element, while_block)))
 
                 case 'ForBlock':
                     style_dict = style_db.get_styles("ForBlock")
                     for_block = ForBlock(element.attrib['label'], style_dict)
-                    for_block.subChart = self.__parse_XML_subChart__(element, style_db)
-                    subChart.add_element(for_block)
+                    stack.append((iter(element), for_block.subChart, partial(target.add_element, for_block)))
 
         return subChart
 
-    def chart_compile(self, style_db: BlockStyleDB) -> str:
-        drawio_flowchart = DrawioFlowChart()
+    def to_XML(self) -> str:
+        # the <flowchart> format parse_XML reads
+        root = ET.Element("flowchart")
+        stack: List[Tuple[FlowChart | SubChart, ET.Element]] = [(self, root)]
+        while stack:
+            chart, parent = stack.pop()
+            for element in chart.elements:
+                node = ET.SubElement(parent, element.get_name(), label=element.label)
+                if isinstance(element, DecisionBlock):
+                    for decision in element.decisions:
+                        stack.append((decision.subChart, ET.SubElement(node, "condition", label=decision.label)))
+                else:
+                    for subChart in element.get_children():
+                        stack.append((subChart, node))
+
+        # ET.tostring recurses on the nesting depth
+        output = io.StringIO()
+        write_element(output, root)
+        return output.getvalue()
+
+    def get_labelled(self) -> List["Element | Decision"]:
+        # every block and branch in reading order, everything that has a label
+        labelled: List[Element | Decision] = []
+        stack: List[Element | Decision] = list(reversed(self.elements))
+        while stack:
+            node = stack.pop()
+            labelled.append(node)
+            if isinstance(node, DecisionBlock):
+                stack.extend(reversed(node.decisions))
+            elif isinstance(node, Decision):
+                stack.extend(reversed(node.subChart.elements))
+            else:
+                stack.extend(reversed([element for subChart in node.get_children() for element in subChart.elements]))
+        return labelled
+
+    def chart_compile(self, style_db: BlockStyleDB, indent: bool = False, compressed: bool = False) -> str:
+        return self.chart_compile_page(style_db).xml_string(indent, compressed)
+
+    def chart_compile_page(self, style_db: BlockStyleDB, name: str = "Page 1", page_id: str = "1") -> "DrawioFlowChart":
+        drawio_flowchart = DrawioFlowChart(name, page_id)
+        self.__compile_into__(drawio_flowchart, style_db)
+        return drawio_flowchart
+
+    def chart_compile_to(self, fileobj: TextIO, style_db: BlockStyleDB, indent: bool = False):
+        # same output as chart_compile, but cells are written out as soon as they are made
+        drawio_flowchart = StreamingDrawioFlowChart(fileobj, indent)
+        self.__compile_into__(drawio_flowchart, style_db)
+        drawio_flowchart.close()
+
+    def __compile_into__(self, drawio_flowchart: "CellSink", style_db: BlockStyleDB):
         terminator_style = style_db.get_styles("TerminatorBlock")
 
+        self.measure_tree()
+
         beginningBlock = BasicBlock("Начало", terminator_style)
+        beginningBlock.assign_ids(drawio_flowchart)
+        self.assign_ids(drawio_flowchart)
         pos = beginningBlock.compile(drawio_flowchart, (0,0))
 
         oldEndID = beginningBlock._endID
@@ -80,10 +189,19 @@ class FlowChart:
             oldEndID = element._endID
 
         endingBlock = BasicBlock("Конец", terminator_style)
+        endingBlock.assign_ids(drawio_flowchart)
         endingBlock.compile(drawio_flowchart, pos)
         drawio_flowchart.connect(oldEndID, endingBlock._startID, label = "")
 
-        return drawio_flowchart.xml_string()
+    def measure_tree(self):
+        # one bottom-up pass so that compile only reads cached sizes
+        for element in self.elements:
+            element.measure_tree()
+
+    def assign_ids(self, drawio_flowchart: "CellSink"):
+        # ids come from the chart being compiled, so compiles never share a counter
+        for element in self.elements:
+            assign_subtree_ids(element, drawio_flowchart)
 
     @staticmethod
     def get_behaviour_descs() -> str:
@@ -96,9 +214,18 @@ class FlowChart:
 class SubChart:
     def __init__(self):
         self.elements: List[Element] = []
+        self._metrics: Tuple[int, int, int] | None = None
+        # the block this sub-chart is drawn inside of
+        self._owner: Element | None = None
 
     def add_element(self, element: "Element"):
-        self.elements.append(element.clone())
+        clone = element.clone()
+        clone._owner = self
+        self.elements.append(clone)
+        self.invalidate()
+
+    def invalidate(self):
+        invalidate_upwards(self)
 
     def get_startID(self):
         return self.elements[0]._startID
@@ -106,49 +233,76 @@ class SubChart:
     def get_endID(self):
         return self.elements[-1]._endID
 
-    def get_width(self) -> int:
+    def ends_in_terminator(self) -> bool:
+        # a branch that ends with return or raise has no way out, nothing may follow its last block
+        style_dict = self.elements[-1]._style_dict
+        return list(style_dict.values())[0]._name == "TerminatorBlock"
+
+    def measure(self) -> Tuple[int, int, int]:
         lwidthMax = 0
         rwidthMax = 0
+        L = 0
         for element in self.elements:
             lwidth = element.get_relative_center()
             rwidth = element.get_width() - lwidth
             lwidthMax = max(lwidthMax, lwidth)
             rwidthMax = max(rwidthMax, rwidth)
+            L += element.get_length() + 40
+        L -= 40
 
-        return lwidthMax + rwidthMax
+        return (lwidthMax + rwidthMax, lwidthMax, L)
 
-    def get_relative_center(self) -> int:
-        lwidthMax = 0
-        for element in self.elements:
-            lwidth = element.get_relative_center()
-            lwidthMax = max(lwidthMax, lwidth)
+    def measure_tree(self):
+        measure_subtree(self)
 
-        return lwidthMax
+    def get_children(self) -> List["Element"]:
+        return self.elements
+
+    def assign_ids(self, drawio_flowchart: "CellSink"):
+        pass
+
+    def get_metrics(self) -> Tuple[int, int, int]:
+        if self._metrics is None:
+            self._metrics = self.measure()
+        return self._metrics
+
+    def get_width(self) -> int:
+        return self.get_metrics()[0]
+
+    def get_relative_center(self) -> int:
+        return self.get_metrics()[1]
 
     def get_length(self) -> int:
-        L = 0
-        for element in self.elements:
-            L += element.get_length() + 40
-        L -= 40
-        return L
+        return self.get_metrics()[2]
+
+    def compile(self, drawio_flowchart: "CellSink", pos: Tuple[int, int]):
+        return run_steps(self.compile_steps(drawio_flowchart, pos))
 
-    def compile(self, drawio_flowchart: "DrawioFlowChart", pos: Tuple[int, int]):
+    def compile_steps(self, drawio_flowchart: "CellSink", pos: Tuple[int, int]) -> CompileSteps:
         oldEndID = 0
         for element in self.elements:
-            pos = element.compile(drawio_flowchart, pos)
+            pos = yield element.compile_steps(drawio_flowchart, pos)
             if (oldEndID != 0): drawio_flowchart.connect(oldEndID, element._startID, "")
             oldEndID = element._endID
         return pos
             
 class Element(ABC):
-    def __init__(self, label: str, style_dict: dict[str, BlockStyle]):
+    # (width, relative center, length), filled lazily or by measure_tree()
+    _metrics: Tuple[int, int, int] | None = None
+    # the sub-chart this element is placed in
+    _owner: SubChart | None = None
+
+    def __init__(self, label: str, style_dict: Mapping[str, BlockStyle]):
         self.label = label
-        self._startID = next(blockID)
-        self._endID = self._startID
+        self._startID = 0
+        self._endID = 0
         self._style_dict = style_dict
 
+    def compile(self, drawio_flowchart: "CellSink", pos: Tuple[int, int]) -> Tuple[int, int]:
+        return run_steps(self.compile_steps(drawio_flowchart, pos))
+
     @abstractmethod
-    def compile(self, drawio_flowchart: "DrawioFlowChart", pos: Tuple[int, int]) -> Tuple[int, int]:
+    def compile_steps(self, drawio_flowchart: "CellSink", pos: Tuple[int, int]) -> CompileSteps:
         pass
 
     @abstractmethod
@@ -156,16 +310,35 @@ class Element(ABC):
         pass
 
     @abstractmethod
-    def get_width(self) -> int:
+    def measure(self) -> Tuple[int, int, int]:
         pass
 
-    @abstractmethod
+    def measure_tree(self):
+        measure_subtree(self)
+
+    def get_children(self) -> List[SubChart]:
+        return []
+
+    def assign_ids(self, drawio_flowchart: "CellSink"):
+        self._startID = drawio_flowchart.next_id()
+        self._endID = self._startID
+
+    def invalidate(self):
+        invalidate_upwards(self)
+
+    def get_metrics(self) -> Tuple[int, int, int]:
+        if self._metrics is None:
+            self._metrics = self.measure()
+        return self._metrics
+
+    def get_width(self) -> int:
+        return self.get_metrics()[0]
+
     def get_relative_center(self) -> int:
-        pass
+        return self.get_metrics()[1]
 
-    @abstractmethod
     def get_length(self) -> int:
-        pass
+        return self.get_metrics()[2]
 
     def get_name(self) -> str:
         return list(self._style_dict.values())[0]._name
@@ -175,26 +348,21 @@ class Element(ABC):
         return "This string will be overridden"
 
 class BasicBlock(Element, FlowChart):
-    def __init__(self, label: str, style_dict: dict[str, BlockStyle]):
+    def __init__(self, label: str, style_dict: Mapping[str, BlockStyle]):
         self.label = label
-        self._startID = next(blockID)
-        self._endID = self._startID
+        self._startID = 0
+        self._endID = 0
         self._style_dict = style_dict
 
     def clone(self) -> "BasicBlock":
         clone = BasicBlock(self.label, self._style_dict)
         return clone
 
-    def get_width(self) -> int:
-        return self._style_dict["block"]._width 
-
-    def get_relative_center(self) -> int:
-        return self._style_dict["block"]._width // 2
-
-    def get_length(self) -> int:
-        return self._style_dict["block"]._height
+    def measure(self) -> Tuple[int, int, int]:
+        style = self._style_dict["block"]
+        return (style._width, style._width // 2, style._height)
 
-    def compile(self, drawio_flowchart: "DrawioFlowChart", pos: Tuple[int, int]) -> Tuple[int, int]:
+    def compile(self, drawio_flowchart: "CellSink", pos: Tuple[int, int]) -> Tuple[int, int]:
         style = self._style_dict["block"]
 
         drawio_flowchart.put_block(
@@ -207,6 +375,11 @@ class BasicBlock(Element, FlowChart):
 
         return (pos[0], pos[1] + style._height + 40)
 
+    def compile_steps(self, drawio_flowchart: "CellSink", pos: Tuple[int, int]) -> CompileSteps:
+        # a leaf, there is nothing to descend into
+        yield from ()
+        return self.compile(drawio_flowchart, pos)
+
     @staticmethod
     def get_desc() -> str:
         return "a block representing one operation"
@@ -238,28 +411,29 @@ class Decision:
         newPos = self.subChart.compile(root, pos);
         return newPos
 
+    def compile_steps(self, root, pos: Tuple[int, int]) -> CompileSteps:
+        return self.subChart.compile_steps(root, pos)
+
 class DecisionBlock(Element, FlowChart):
-    def __init__(self, label: str, style_dict: dict[str, BlockStyle]):
+    def __init__(self, label: str, style_dict: Mapping[str, BlockStyle]):
         self.label = label
-        self._startID = next(blockID)
-        self._endID = next(blockID)
+        self._startID = 0
+        self._endID = 0
         self._style_dict = style_dict 
         self.decisions: List[Decision] = []
 
-    def get_width(self) -> int:
-        if len(self.decisions) == 1:
-            return self.decisions[0].get_width() + 20
+    def measure(self) -> Tuple[int, int, int]:
+        N = len(self.decisions)
 
-        W = 0
-        for decision in self.decisions:
-            W += decision.get_width() + 40
-        W -= 40
-        return W
+        if N == 1:
+            W = self.decisions[0].get_width() + 20
+        else:
+            W = 0
+            for decision in self.decisions:
+                W += decision.get_width() + 40
+            W -= 40
 
-    def get_relative_center(self) -> int:
-        N = len(self.decisions)
         dx = 0
-
         if (N % 2 == 0):
             C = N // 2 - 1
             for i in range(C + 1):
@@ -270,26 +444,37 @@ class DecisionBlock(Element, FlowChart):
             for i in range(C + 1):
                 dx += self.decisions[i].get_width() + 40
             dx += self.decisions[C+1].get_relative_center()
-        return dx
 
-    def get_max_decision_height(self) -> int:
         L = self.decisions[0].get_length()
         for decision in self.decisions:
             L = max(L, decision.get_length())
-        return L
 
-    def get_length(self) -> int:
-        return self.get_max_decision_height() + self._style_dict["block"]._height + 40
+        return (W, dx, L + self._style_dict["block"]._height + 40)
+
+    def get_children(self) -> List[SubChart]:
+        return [decision.subChart for decision in self.decisions]
+
+    def assign_ids(self, drawio_flowchart: "CellSink"):
+        self._startID = drawio_flowchart.next_id()
+        self._endID = drawio_flowchart.next_id()
+
+    def get_max_decision_height(self) -> int:
+        return self.get_length() - self._style_dict["block"]._height - 40
 
     def add_decision(self, decision: Decision):
+        decision.subChart._owner = self
         self.decisions.append(decision)
+        self.invalidate()
 
     def clone(self) -> "DecisionBlock":
         clone = DecisionBlock(self.label, self._style_dict)
         clone.decisions = self.decisions.copy()
+        # the branches are shared, changes in them now resize the clone
+        for decision in clone.decisions:
+            decision.subChart._owner = clone
         return clone
 
-    def compile(self, drawio_flowchart: "DrawioFlowChart", pos: Tuple[int, int]) -> Tuple[int, int]:
+    def compile_steps(self, drawio_flowchart: "CellSink", pos: Tuple[int, int]) -> CompileSteps:
         style = self._style_dict["block"]
 
         drawio_flowchart.put_block(
@@ -316,10 +501,9 @@ class DecisionBlock(Element, FlowChart):
 
         for i in range(N):
             decision = self.decisions[i]
-            decision.compile(drawio_flowchart, startingPos)
-            style_dict = decision.subChart.elements[-1]._style_dict
+            yield decision.compile_steps(drawio_flowchart, startingPos)
 
-            if list(style_dict.values())[0]._name != "TerminatorBlock":
+            if not decision.subChart.ends_in_terminator():
                 drawio_flowchart.connect(
                         idA=decision.get_endID(), 
                         idB=self._endID, 
@@ -333,7 +517,7 @@ class DecisionBlock(Element, FlowChart):
             else:
                 constraintPos = (startingPos[0] + decision.get_relative_center(), pos[1] + style._height // 2)
 
-            decision_point_id = next(blockID)
+            decision_point_id = drawio_flowchart.next_id()
             drawio_flowchart.put_point(decision_point_id, startingPos[0] + style._width // 2, startingPos[1] - 40)
             drawio_flowchart.connect(self._startID, decision_point_id, "", constraintPos)
             drawio_flowchart.connect(decision_point_id, decision.get_startID(), decision.label)
@@ -350,30 +534,37 @@ class DecisionBlock(Element, FlowChart):
         return "a block representing if and case switch statements"
 
 class WhileBlock(Element, FlowChart):
-    def __init__(self, label: str, style_dict: dict[str, BlockStyle]):
+    def __init__(self, label: str, style_dict: Mapping[str, BlockStyle]):
         self.label = label
         self.subChart = SubChart()
-        self._startID = next(blockID)
-        self._endID = next(blockID)
+        self.subChart._owner = self
+        self._startID = 0
+        self._endID = 0
         self._style_dict = style_dict
 
     def clone(self) -> "WhileBlock":
         clone = WhileBlock(self.label, self._style_dict)
         clone.subChart = self.subChart
+        clone.subChart._owner = clone
         return clone
 
-    def get_width(self) -> int:
-        return self.subChart.get_width() + 20
+    def measure(self) -> Tuple[int, int, int]:
+        return (
+                self.subChart.get_width() + 20,
+                self.subChart.get_relative_center(),
+                self._style_dict["block"]._height + self.subChart.get_length() + 40
+                )
 
-    def get_relative_center(self) -> int:
-        return self.subChart.get_relative_center()
+    def get_children(self) -> List[SubChart]:
+        return [self.subChart]
 
-    def get_length(self) -> int:
-        return self._style_dict["block"]._height + self.subChart.get_length() + 40
+    def assign_ids(self, drawio_flowchart: "CellSink"):
+        self._startID = drawio_flowchart.next_id()
+        self._endID = drawio_flowchart.next_id()
 
-    def compile(self, drawio_flowchart: "DrawioFlowChart", pos: Tuple[int, int]) -> Tuple[int, int]:
+    def compile_steps(self, drawio_flowchart: "CellSink", pos: Tuple[int, int]) -> CompileSteps:
         style = self._style_dict["block"]
-        main_block_id = next(blockID)
+        main_block_id = drawio_flowchart.next_id()
 
         drawio_flowchart.put_point(
                 ID=self._startID,
@@ -392,16 +583,17 @@ class WhileBlock(Element, FlowChart):
         drawio_flowchart.connect(self._startID, main_block_id)
         drawio_flowchart.connect(main_block_id, self.subChart.get_startID(), "Истина")
 
-        endPos = self.subChart.compile(drawio_flowchart, (pos[0], pos[1] + style._height + 40))
+        endPos = yield self.subChart.compile_steps(drawio_flowchart, (pos[0], pos[1] + style._height + 40))
 
-        loop_point_id = next(blockID)
-        drawio_flowchart.put_point(loop_point_id, endPos[0] + style._width // 2, endPos[1] - 20)
-        drawio_flowchart.connect(self.subChart.get_endID(), loop_point_id)
-        constr_pos = (
-                pos[0] + style._width // 2 + self.subChart.get_width() - self.subChart.get_relative_center() + 20,
-                endPos[1] - 20
-                )
-        drawio_flowchart.connect(loop_point_id, self._startID, "", constr_pos, True)
+        if not self.subChart.ends_in_terminator():
+            loop_point_id = drawio_flowchart.next_id()
+            drawio_flowchart.put_point(loop_point_id, endPos[0] + style._width // 2, endPos[1] - 20)
+            drawio_flowchart.connect(self.subChart.get_endID(), loop_point_id)
+            constr_pos = (
+                    pos[0] + style._width // 2 + self.subChart.get_width() - self.subChart.get_relative_center() + 20,
+                    endPos[1] - 20
+                    )
+            drawio_flowchart.connect(loop_point_id, self._startID, "", constr_pos, True)
 
         drawio_flowchart.put_point(self._endID, endPos[0] + style._width // 2, endPos[1])
         constr_pos = (
@@ -417,39 +609,47 @@ class WhileBlock(Element, FlowChart):
         return "a block representing while loops"
 
 class ForBlock(Element, FlowChart):
-    def __init__(self, label: str, style_dict: dict[str, BlockStyle]):
+    def __init__(self, label: str, style_dict: Mapping[str, BlockStyle]):
         self.label = label
         self.subChart = SubChart()
-        self._startID = next(blockID)
-        self._endID = next(blockID)
+        self.subChart._owner = self
+        self._startID = 0
+        self._endID = 0
         self._style_dict = style_dict
 
     def clone(self) -> "ForBlock":
         clone = ForBlock(self.label, self._style_dict)
         clone.subChart = self.subChart
+        clone.subChart._owner = clone
         return clone
 
-    def get_width(self) -> int:
-        return self.subChart.get_width() + 20
-
-    def get_relative_center(self) -> int:
-        return self.subChart.get_relative_center()
-
-    def get_length(self) -> int:
+    def measure(self) -> Tuple[int, int, int]:
         style_begin = self._style_dict["beginning"]
         style_end = self._style_dict["end"]
 
-        return style_begin._height + self.subChart.get_length() + style_end._height + 80
+        return (
+                self.subChart.get_width() + 20,
+                self.subChart.get_relative_center(),
+                style_begin._height + self.subChart.get_length() + style_end._height + 80
+                )
+
+    def get_children(self) -> List[SubChart]:
+        return [self.subChart]
+
+    def assign_ids(self, drawio_flowchart: "CellSink"):
+        self._startID = drawio_flowchart.next_id()
+        self._endID = drawio_flowchart.next_id()
 
-    def compile(self, drawio_flowchart: "DrawioFlowChart", pos: Tuple[int, int]) -> Tuple[int, int]:
+    def compile_steps(self, drawio_flowchart: "CellSink", pos: Tuple[int, int]) -> CompileSteps:
         style_begin = self._style_dict["beginning"]
         style_end = self._style_dict["end"]
 
         drawio_flowchart.put_block(self._startID, self.label, style_begin, pos[0], pos[1])
-        end_pos = self.subChart.compile(drawio_flowchart, (pos[0], pos[1] + style_begin._height + 40))
+        end_pos = yield self.subChart.compile_steps(drawio_flowchart, (pos[0], pos[1] + style_begin._height + 40))
         drawio_flowchart.connect(self._startID, self.subChart.get_startID())
         drawio_flowchart.put_block(self._endID, self.label, style_end, end_pos[0], end_pos[1])
-        drawio_flowchart.connect(self.subChart.get_endID(), self._endID)
+        if not self.subChart.ends_in_terminator():
+            drawio_flowchart.connect(self.subChart.get_endID(), self._endID)
 
         return (end_pos[0], end_pos[1] + style_end._height + 40)
 
@@ -457,49 +657,196 @@ class ForBlock(Element, FlowChart):
     def get_desc() -> str:
         return "a block representing for loops"
 
-class DrawioFlowChart:
+ATTRIB_ESCAPES = str.maketrans({
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    '"': "&quot;",
+    "\n": "&#10;",
+    "\r": "&#13;",
+    "\t": "&#09;",
+    })
+
+TEXT_ESCAPES = str.maketrans({
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    })
+
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
+
+GOST_FONT = "fontFamily=GOST;fontSource=http%3A%2F%2Fmurena.io%2Fs%2FwJdr83WFBzcZGHY%2Fdownload%2FGOST.woff;"
+
+# built once, every edge and point shares the same string object
+EDGE_STYLES = {
+    endTip: f"edgeStyle=orthogonalEdgeStyle;rounded=0;orthogonalLoop=1;jettySize=auto;html=1;strokeWidth=2;endArrow={'classicThin' if endTip else 'none'};endFill=0;{GOST_FONT}"
+    for endTip in (False, True)
+    }
+POINT_STYLE = f"strokeWidth=2;html=1;shape=mxgraph.flowchart.start_2;whiteSpace=wrap;{GOST_FONT}"
+
+@lru_cache(maxsize=1024)
+def escape_attrib(value: str) -> str:
+    # style strings repeat on every cell, so they are escaped only once
+    return value.translate(ATTRIB_ESCAPES)
+
+def start_tag(element: ET.Element) -> str:
+    attributes = "".join(f' {key}="{escape_attrib(value)}"' for key, value in element.items())
+    return f"<{element.tag}{attributes}"
+
+def write_element(fileobj: TextIO, element: ET.Element, indent: bool = False, depth: int = 0):
+    newline = "\n" if indent else ""
+
+    stack: List[Tuple[ET.Element, int, bool]] = [(element, depth, False)]
+    while stack:
+        element, depth, closing = stack.pop()
+        padding = " " * depth if indent else ""
+
+        if closing:
+            fileobj.write(f"{padding}</{element.tag}>{newline}")
+            continue
+
+        if len(element) == 0 and not element.text:
+            fileobj.write(f"{padding}{start_tag(element)}/>{newline}")
+            continue
+
+        if len(element) == 0:
+            fileobj.write(f"{padding}{start_tag(element)}>{element.text.translate(TEXT_ESCAPES)}</{element.tag}>{newline}")
+            continue
+
+        fileobj.write(f"{padding}{start_tag(element)}>{newline}")
+        stack.append((element, depth, True))
+        for child in reversed(element):
+            stack.append((child, depth + 1, False))
+
+def compress_diagram(xml_string: str) -> str:
+    # draw.io's compressed <diagram> payload: base64(deflateRaw(encodeURIComponent(xml)))
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    data = compressor.compress(quote(xml_string, safe="~()*!.'").encode("ascii")) + compressor.flush()
+    return base64.b64encode(data).decode("ascii")
+
+def decompress_diagram(data: str) -> str:
+    xml_string = zlib.decompress(base64.b64decode(data), -15).decode("ascii")
+    return unquote(xml_string)
+
+def decode_drawio(document: str, indent: bool = False) -> str:
+    # turns every compressed page of a .drawio document back into a plain mxGraphModel
+    mxfile = ET.fromstring(document)
+    for diagram in mxfile.iter("diagram"):
+        if len(diagram) != 0 or not diagram.text or diagram.text.isspace():
+            continue
+        diagram.append(ET.fromstring(decompress_diagram(diagram.text.strip())))
+        diagram.text = None
+
+    buffer = io.StringIO()
+    write_mxfile(buffer, mxfile, indent)
+    return buffer.getvalue()
+
+def extract_page(document: str, page: int) -> str:
+    # a .drawio document with only one of its pages, for exporters that always show the first one
+    mxfile = ET.fromstring(document)
+    diagrams = mxfile.findall("diagram")
+    kept = diagrams[page]
+    for diagram in diagrams:
+        if diagram is not kept: mxfile.remove(diagram)
+
+    buffer = io.StringIO()
+    write_mxfile(buffer, mxfile)
+    return buffer.getvalue()
+
+def write_mxfile(fileobj: TextIO, mxfile: ET.Element, indent: bool = False, compressed: bool = False):
+    fileobj.write(XML_DECLARATION)
+    if not compressed:
+        write_element(fileobj, mxfile, indent)
+        return
+
+    compressed_mxfile = ET.Element(mxfile.tag, mxfile.attrib)
+    for diagram in mxfile:
+        model = io.StringIO()
+        write_element(model, diagram[0])
+        compressed_diagram = ET.SubElement(compressed_mxfile, diagram.tag, diagram.attrib)
+        compressed_diagram.text = compress_diagram(model.getvalue())
+    write_element(fileobj, compressed_mxfile, indent)
+
+class DrawioDocument:
+    # one .drawio file with a page per flowchart
+    def __init__(self):
+        self._mxfile = ET.Element('mxfile')
+        self._mxfile.set("host", "app.diagrams.net")
+
+    def add_page(self, drawio_flowchart: "DrawioFlowChart"):
+        diagram = drawio_flowchart._mxfile[0]
+        diagram.set("id", str(len(self._mxfile) + 1))
+        self._mxfile.append(diagram)
+
+    def add_flowchart(self, name: str, flowchart: FlowChart, style_db: BlockStyleDB):
+        self.add_page(flowchart.chart_compile_page(style_db, name))
+
+    def get_page_names(self) -> List[str]:
+        return [diagram.get("name", "") for diagram in self._mxfile]
+
+    def xml_string(self, indent: bool = False, compressed: bool = False) -> str:
+        buffer = io.StringIO()
+        self.write_to(buffer, indent, compressed)
+        return buffer.getvalue()
+
+    def write_to(self, fileobj: TextIO, indent: bool = False, compressed: bool = False):
+        write_mxfile(fileobj, self._mxfile, indent, compressed)
+
+def new_page(name: str, page_id: str) -> Tuple[ET.Element, ET.Element]:
+    # an mxfile with one empty page, and the <root> its cells go into
+    mxfile = ET.Element('mxfile')
+    mxfile.set("host", "app.diagrams.net")
+
+    diagram = ET.SubElement(mxfile, "diagram")
+    diagram.set("name", name)
+    diagram.set("id", page_id)
+
+    mxGraphModel = ET.SubElement(diagram, "mxGraphModel")
+    mxGraphModel.set("dx", "559")
+    mxGraphModel.set("dy", "777")
+    mxGraphModel.set("grid", "1")
+    mxGraphModel.set("gridSize", "10")
+    mxGraphModel.set("guides", "1")
+    mxGraphModel.set("tooltips", "1")
+    mxGraphModel.set("connect", "1")
+    mxGraphModel.set("arrows", "1")
+    mxGraphModel.set("fold", "1")
+    mxGraphModel.set("page", "1")
+    mxGraphModel.set("pageScale", "1")
+    mxGraphModel.set("pageWidth", "827")
+    mxGraphModel.set("pageHeight", "1129")
+    mxGraphModel.set("math", "0")
+    mxGraphModel.set("shadow", "0")
+
+    return mxfile, ET.SubElement(mxGraphModel, "root")
+
+class CellSink(ABC):
+    # what compile needs: ids and somewhere to put blocks, points and edges
     def __init__(self):
-        mxfile = ET.Element('mxfile')
-        mxfile.set("host", "app.diagrams.net")
-    
-        diagram = ET.SubElement(mxfile, "diagram")
-        diagram.set("name", "Page 1")
-        diagram.set("id", "1")
-    
-        mxGraphModel = ET.SubElement(diagram, "mxGraphModel")
-        mxGraphModel.set("dx", "559")
-        mxGraphModel.set("dy", "777")
-        mxGraphModel.set("grid", "1")
-        mxGraphModel.set("gridSize", "10")
-        mxGraphModel.set("guides", "1")
-        mxGraphModel.set("tooltips", "1")
-        mxGraphModel.set("connect", "1")
-        mxGraphModel.set("arrows", "1")
-        mxGraphModel.set("fold", "1")
-        mxGraphModel.set("page", "1")
-        mxGraphModel.set("pageScale", "1")
-        mxGraphModel.set("pageWidth", "827")
-        mxGraphModel.set("pageHeight", "1129")
-        mxGraphModel.set("math", "0")
-        mxGraphModel.set("shadow", "0")
-
-        self._mxfile = mxfile
-        self._root = ET.SubElement(mxGraphModel, "root")
+        self._ids = iter(IDIterator())
 
+    @abstractmethod
+    def add_cell(self, cell: ET.Element):
+        pass
+
+    def add_root_cells(self):
         # add the weird id = 0 and id = 1 blocks
-        root_cell_0 = ET.SubElement(self._root, "mxCell")
+        root_cell_0 = ET.Element("mxCell")
         root_cell_0.set("id", "0")
-        root_cell_1 = ET.SubElement(self._root, "mxCell")
+        self.add_cell(root_cell_0)
+        root_cell_1 = ET.Element("mxCell")
         root_cell_1.set("id", "1")
         root_cell_1.set("parent", "0")
+        self.add_cell(root_cell_1)
 
+    def next_id(self) -> int:
+        return next(self._ids)
 
     def connect(self, idA: int, idB: int, label: str = "", constraintPos: Tuple[int, int] = (0,0), endTip: bool = False):
-        arrow = ET.SubElement(self._root, "mxCell")
-        arrow.set("id", str(next(blockID)))
+        arrow = ET.Element("mxCell")
+        arrow.set("id", str(self.next_id()))
         arrow.set("value", label)
-        endArrow = "classicThin" if endTip else "none"        
-        arrow.set("style", f"edgeStyle=orthogonalEdgeStyle;rounded=0;orthogonalLoop=1;jettySize=auto;html=1;strokeWidth=2;endArrow={endArrow};endFill=0;fontFamily=GOST;fontSource=http%3A%2F%2Fmurena.io%2Fs%2FwJdr83WFBzcZGHY%2Fdownload%2FGOST.woff;")
+        arrow.set("style", EDGE_STYLES[endTip])
         arrow.set("edge", "1")
         arrow.set("parent", "1")
         arrow.set("source", str(idA))
@@ -508,19 +855,21 @@ class DrawioFlowChart:
         geometry.set("relative", "1")
         geometry.set("as", "geometry")
 
-        if (constraintPos == (0, 0)): return
-        pointsArray = ET.SubElement(geometry, "Array")
-        pointsArray.set("as", "points")
+        if (constraintPos != (0, 0)):
+            pointsArray = ET.SubElement(geometry, "Array")
+            pointsArray.set("as", "points")
 
-        constraintPoint = ET.SubElement(pointsArray, "mxPoint")
-        constraintPoint.set("x", str(constraintPos[0]))
-        constraintPoint.set("y", str(constraintPos[1]))
+            constraintPoint = ET.SubElement(pointsArray, "mxPoint")
+            constraintPoint.set("x", str(constraintPos[0]))
+            constraintPoint.set("y", str(constraintPos[1]))
+
+        self.add_cell(arrow)
 
     def put_point(self, ID: int, x: int, y: int):
-        point = ET.SubElement(self._root, "mxCell")
+        point = ET.Element("mxCell")
         point.set("id", str(ID))
         point.set("value", "")
-        point.set("style", "strokeWidth=2;html=1;shape=mxgraph.flowchart.start_2;whiteSpace=wrap;fontFamily=GOST;fontSource=http%3A%2F%2Fmurena.io%2Fs%2FwJdr83WFBzcZGHY%2Fdownload%2FGOST.woff;")
+        point.set("style", POINT_STYLE)
         point.set("vertex", "1")
         point.set("parent", "1")
         geometry = ET.SubElement(point, "mxGeometry")
@@ -529,9 +878,10 @@ class DrawioFlowChart:
         geometry.set("width", "0")
         geometry.set("height", "0")
         geometry.set("as", "geometry")
+        self.add_cell(point)
 
     def put_block(self, ID: int, label: str, style: BlockStyle, x: int, y: int):
-        block = ET.SubElement(self._root, "mxCell")
+        block = ET.Element("mxCell")
         block.set("id", str(ID))
         block.set("value", label)
         block.set("style", style.drawio_style_string())
@@ -543,8 +893,51 @@ class DrawioFlowChart:
         geometry.set("width", str(style._width))
         geometry.set("height", str(style._height))
         geometry.set("as", "geometry")
-
-    def xml_string(self) -> str:
-        xml_string = ET.tostring(self._mxfile, "unicode")
-        return BeautifulSoup(xml_string, "xml").prettify()
-
+        self.add_cell(block)
+
+class DrawioFlowChart(CellSink):
+    def __init__(self, name: str = "Page 1", page_id: str = "1"):
+        super().__init__()
+        self._mxfile, self._root = new_page(name, page_id)
+        self.add_root_cells()
+
+    def add_cell(self, cell: ET.Element):
+        self._root.append(cell)
+
+    def xml_string(self, indent: bool = False, compressed: bool = False) -> str:
+        buffer = io.StringIO()
+        self.write_to(buffer, indent, compressed)
+        return buffer.getvalue()
+
+    def write_to(self, fileobj: TextIO, indent: bool = False, compressed: bool = False):
+        write_mxfile(fileobj, self._mxfile, indent, compressed)
+
+class StreamingDrawioFlowChart(CellSink):
+    # writes every cell to fileobj as soon as it is added, the page never exists as a tree
+    def __init__(self, fileobj: TextIO, indent: bool = False, name: str = "Page 1", page_id: str = "1"):
+        super().__init__()
+        self._fileobj = fileobj
+        self._indent = indent
+
+        mxfile, root = new_page(name, page_id)
+        diagram = mxfile[0]
+        mxGraphModel = diagram[0]
+        self._parents = [mxfile, diagram, mxGraphModel, root]
+
+        newline = "\n" if indent else ""
+        fileobj.write(XML_DECLARATION)
+        for depth, parent in enumerate(self._parents):
+            padding = " " * depth if indent else ""
+            fileobj.write(f"{padding}{start_tag(parent)}>{newline}")
+
+        self.add_root_cells()
+
+    def add_cell(self, cell: ET.Element):
+        write_element(self._fileobj, cell, self._indent, len(self._parents))
+
+    def close(self):
+        newline = "\n" if self._indent else ""
+        for depth in reversed(range(len(self._parents))):
+            padding = " " * depth if self._indent else ""
+            self._fileobj.write(f"{padding}</{self._parents[depth].tag}>{newline}")
+        self._fileobj.flush()
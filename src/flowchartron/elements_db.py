@@ -1,5 +1,6 @@
 import sqlite3
-from typing import List
+from types import MappingProxyType
+from typing import List, Mapping
 
 class BlockStyle:
     def __init__(self, 
@@ -34,8 +35,15 @@ class BlockStyle:
         self._gpt_desc = gpt_desc
         self._behaviour_type = behaviour_type
         self._element_type = element_type
+        self._drawio_style: str | None = None
 
     def drawio_style_string(self) -> str:
+        # styles are shared through BlockStyleDB, so the string is formatted once per style
+        if self._drawio_style is None:
+            self._drawio_style = self.__format_drawio_style__()
+        return self._drawio_style
+
+    def __format_drawio_style__(self) -> str:
         L: List[str] = ["html=1", "whiteSpace=wrap"]
         L.append(f"shape={self._render_style}")
         L.append(f"strokeWidth={self._stroke_width}")
@@ -50,6 +58,8 @@ class BlockStyleDB:
     def __init__(self, file_name: str):
         self.con = sqlite3.connect(file_name)
         self.cur = self.con.cursor()
+        # name -> element_type -> shared style, loaded on first use
+        self._registry: Mapping[str, Mapping[str, BlockStyle]] | None = None
 
         self.cur.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='BLOCKS'")
         table_exists = self.cur.fetchone()
@@ -223,12 +233,18 @@ class BlockStyleDB:
             L.append(f"{row[1]}: {row[4]}, behaviour: {row[2]}")
         return "\n".join(L)
 
-    def get_styles(self, block_name: str) -> dict[str, BlockStyle]:
-        self.cur.execute(f'''SELECT * FROM BLOCKS WHERE name = ?''', (block_name,))
+    def get_styles(self, block_name: str) -> Mapping[str, BlockStyle]:
+        if self._registry is None:
+            self._registry = self.__load_registry__()
+        return self._registry.get(block_name, MappingProxyType({}))
+
+    def __load_registry__(self) -> Mapping[str, Mapping[str, BlockStyle]]:
+        self.cur.execute(f'''SELECT * FROM BLOCKS''')
         unformatted_styles = self.cur.fetchall()
-        
-        style_dict: dict[str, BlockStyle] = {}
+
+        registry: dict[str, dict[str, BlockStyle]] = {}
         for row in unformatted_styles:
+            style_dict = registry.setdefault(row[1], {})
             style_dict[row[3]] = BlockStyle(
                     name=row[1],
                     behaviour_type=row[2],
@@ -244,7 +260,8 @@ class BlockStyleDB:
                     point_param=row[12],
                     arc_param=row[13]
                     )
-        return style_dict
+
+        return MappingProxyType({name: MappingProxyType(style_dict) for name, style_dict in registry.items()})
 
     def add_style(self, style: BlockStyle):
         n = style._name
@@ -262,8 +279,10 @@ class BlockStyleDB:
         ap = style._arc_param
         self.cur.execute(f'''INSERT INTO BLOCKS (name, behaviour_type, element_type, gpt_desc, width, height, render_style, stroke_width, font_family, font_source, direction, point_param, arc_param) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (n, bt, et, gd, w, h, r, s, ff, fs, d, pp, ap))
         self.con.commit()
+        self._registry = None
 
     def del_style(self, style_name: str):
         self.cur.execute(f'''DELETE FROM BLOCKS WHERE name = ?''', (style_name,))
         self.con.commit()
+        self._registry = None
     
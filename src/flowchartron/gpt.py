@@ -1,88 +1,206 @@
-import requests, re, json
+import requests, json, os
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Iterator
+from flowchartron.chat_cache import ChatCacheDB
 
-class DuckChat:
-    def __init__(self):
-        self.url = 'https://duckduckgo.com/duckchat/v1/chat'
+CHAT_URL = 'https://duckduckgo.com/duckchat/v1/chat'
+STATUS_URL = 'https://duckduckgo.com/duckchat/v1/status'
+MODEL = 'gpt-3.5-turbo-0125'
+
+CHAT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:124.0) Gecko/20100101 Firefox/124.0",
+    "Accept": "text/event-stream",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Referer": "https://duckduckgo.com/",
+    "Content-Type": "application/json",
+    "x-vqd-4": "",
+    "Origin": "https://duckduckgo.com",
+    "Connection": "keep-alive",
+    "Cookie": "5=1; 7=282828; 8=fbf1c7; 9=fe8019; 21=3b3735; j=282828; aa=f9bc2e; x=b7ba25; ah=ru-ru; l=wt-wt; aq=-1; ay=b; dcm=3; ap=-1; ax=-1; ak=-1; psb=-1; aj=m; ao=-1; au=-1",
+    "Sec-Fetch-Dest": "empty",
+    "Sec-Fetch-Mode": "cors",
+    "Sec-Fetch-Site": "same-origin",
+    "TE": "trailers"
+}
+
+STATUS_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:124.0) Gecko/20100101 Firefox/124.0',
+    'Accept': '*/*',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Referer': 'https://duckduckgo.com/',
+    'Connection': 'keep-alive',
+    'Cookie': '5=1; 7=282828; 8=fbf1c7; 9=fe8019; 21=3b3735; j=282828; aa=f9bc2e; x=b7ba25; ah=ru-ru; l=wt-wt; aq=-1; ay=b; dcm=3; ap=-1; ax=-1; ak=-1; psb=-1; aj=m; ao=-1; au=-1',
+    'Sec-Fetch-Dest': 'empty',
+    'Sec-Fetch-Mode': 'no-cors',
+    'Sec-Fetch-Site': 'same-origin',
+    'TE': 'trailers',
+    'Cache-Control': 'no-store, no-cache',
+    'x-vqd-accept': '1',
+    'Pragma': 'no-cache'
+}
+
+def chat_request(model: str, message: str) -> dict:
+    return {
+        'model': model,
+        'messages': [
+            {
+                'role': 'user',
+                'content': message
+            }
+        ]
+    }
+
+def parse_data_line(line: bytes) -> dict | None:
+    # the JSON object of one event stream line, {} for lines without any and None once the reply is over
+    if not line.startswith(b"data: "): return {}
+    jsonData = line[len(b"data: "):].decode("utf-8")
+    if jsonData == "[DONE]": return None
+    try:
+        return json.loads(jsonData)
+    except json.JSONDecodeError:
+        return {}
+
+def parse_event(line: bytes) -> str | None:
+    # the text carried by one DuckChat event, "" for lines without any and None once the reply is over
+    parsedData = parse_data_line(line)
+    if parsedData is None: return None
+    return parsedData.get("message", "")
+
+def parse_openai_event(line: bytes) -> str | None:
+    # the same for the chunks of an OpenAI style /chat/completions stream
+    parsedData = parse_data_line(line)
+    if parsedData is None: return None
+    choices = parsedData.get("choices") or [{}]
+    return choices[0].get("delta", {}).get("content") or ""
+
+class ChatBackend(ABC):
+    # a chat model behind some HTTP API, subclasses only have to stream the reply to a single message
+    def __init__(self, model: str, cache: ChatCacheDB | None = None):
+        self.model = model
+        self.cache = cache
+
+    @abstractmethod
+    def stream_message(self, message: str) -> Iterator[str]:
+        pass
+
+    def send_message(self,
+                     message: str,
+                     on_partial: Callable[[str], None] | None = None,
+                     stop_when: Callable[[str], bool] | None = None,
+                     ) -> str:
+        # on_partial gets the reply so far after every piece, stop_when can end the reply early
+        if self.cache is not None:
+            cached = self.cache.get_response(self.model, message)
+            if cached is not None:
+                if on_partial is not None: on_partial(cached)
+                return cached
+
+        response_message = ""
+        stream = self.stream_message(message)
+        try:
+            for piece in stream:
+                response_message += piece
+                if on_partial is not None: on_partial(response_message)
+                if stop_when is not None and stop_when(response_message): break
+        finally:
+            # closes the response right away when the reply is cut short or a callback raised
+            stream.close()
+
+        if self.cache is not None and response_message != "":
+            self.cache.add_response(self.model, message, response_message)
+        return response_message
+
+class DuckChat(ChatBackend):
+    def __init__(self, cache: ChatCacheDB | None = None):
+        super().__init__(MODEL, cache)
+        self.url = CHAT_URL
+        # one pooled session keeps the TLS connection alive between messages
+        self.session = requests.Session()
+        self.headers = dict(CHAT_HEADERS)
+
+    def refresh_token(self):
+        response = self.session.get(STATUS_URL, headers=STATUS_HEADERS)
+        self.headers["x-vqd-4"] = response.headers.get("x-vqd-4", "")
+
+    def stream_message(self, message: str) -> Iterator[str]:
+        # the token is only fetched once the network is really needed
+        if self.headers["x-vqd-4"] == "":
+            self.refresh_token()
+
+        response = self.session.post(self.url, headers=self.headers, json=chat_request(self.model, message), stream=True)
+        # every reply carries the token for the next message, /status is only needed without it
+        self.headers["x-vqd-4"] = response.headers.get("x-vqd-4", "")
+
+        try:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                piece = parse_event(line)
+                if piece is None: break
+                if piece != "": yield piece
+        finally:
+            response.close()
+
+class OpenAIChat(ChatBackend):
+    # any server speaking the OpenAI /chat/completions API: our own gateway, a local model, the replay server
+    def __init__(self, api_base: str, api_key: str = "", model: str = MODEL, cache: ChatCacheDB | None = None):
+        super().__init__(model, cache)
+        self.url = api_base.rstrip("/") + "/chat/completions"
+        self.session = requests.Session()
         self.headers = {
-            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:124.0) Gecko/20100101 Firefox/124.0",
-            "Accept": "text/event-stream",
-            "Accept-Language": "en-US,en;q=0.5",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Referer": "https://duckduckgo.com/",
             "Content-Type": "application/json",
-            "x-vqd-4": "",
-            "Content-Length": "73",
-            "Origin": "https://duckduckgo.com",
-            "Connection": "keep-alive",
-            "Cookie": "5=1; 7=282828; 8=fbf1c7; 9=fe8019; 21=3b3735; j=282828; aa=f9bc2e; x=b7ba25; ah=ru-ru; l=wt-wt; aq=-1; ay=b; dcm=3; ap=-1; ax=-1; ak=-1; psb=-1; aj=m; ao=-1; au=-1",
-            "Sec-Fetch-Dest": "empty",
-            "Sec-Fetch-Mode": "cors",
-            "Sec-Fetch-Site": "same-origin",
-            "TE": "trailers"
+            "Accept": "text/event-stream",
         }
-        self.refresh_token()
+        if api_key != "": self.headers["Authorization"] = f"Bearer {api_key}"
 
-    def refresh_token(self):
-        url = 'https://duckduckgo.com/duckchat/v1/status'
-
-        tokenHeaders = {
-            'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:124.0) Gecko/20100101 Firefox/124.0',
-            'Accept': '*/*',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Referer': 'https://duckduckgo.com/',
-            'Connection': 'keep-alive',
-            'Cookie': '5=1; 7=282828; 8=fbf1c7; 9=fe8019; 21=3b3735; j=282828; aa=f9bc2e; x=b7ba25; ah=ru-ru; l=wt-wt; aq=-1; ay=b; dcm=3; ap=-1; ax=-1; ak=-1; psb=-1; aj=m; ao=-1; au=-1',
-            'Sec-Fetch-Dest': 'empty',
-            'Sec-Fetch-Mode': 'no-cors',
-            'Sec-Fetch-Site': 'same-origin',
-            'TE': 'trailers',
-            'Cache-Control': 'no-store, no-cache',
-            'x-vqd-accept': '1',
-            'Pragma': 'no-cache'
-        }
-        response = requests.get(url, headers=tokenHeaders)
-        self.headers["x-vqd-4"] = str(response.headers.get("x-vqd-4"))
-
-    def send_message(self, message):
-        data = {
-            'model': 'gpt-3.5-turbo-0125',
-            'messages': [
-                {
-                    'role': 'user',
-                    'content': message
-                }
-            ]
-        }
+    def stream_message(self, message: str) -> Iterator[str]:
+        data = chat_request(self.model, message)
+        data["stream"] = True
+
+        response = self.session.post(self.url, headers=self.headers, json=data, stream=True)
+        try:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                piece = parse_openai_event(line)
+                if piece is None: break
+                if piece != "": yield piece
+        finally:
+            response.close()
 
-        response = requests.post(self.url, headers=self.headers, json=data)
-        print(response.reason)
-        self.refresh_token()
+def get_config() -> Dict[str, str]:
+    # the chat backend is picked through the environment, so the GUI, batch and benchmarks share it
+    return {
+        "backend": os.environ.get("FLOWCHARTRON_BACKEND", "duckchat"),
+        "api_base": os.environ.get("FLOWCHARTRON_API_BASE", "http://127.0.0.1:8000/v1"),
+        "api_key": os.environ.get("FLOWCHARTRON_API_KEY", ""),
+        "model": os.environ.get("FLOWCHARTRON_MODEL", MODEL),
+        "cache": os.environ.get("FLOWCHARTRON_CHAT_CACHE", "chat_cache.db"),
+    }
 
-        response_text = response.content.decode("utf-8")
-        pattern = """data: (.*)"""
-        matches = re.finditer(pattern, response_text)
+def make_cache(config: Dict[str, str]) -> ChatCacheDB | None:
+    # an empty path turns the response cache off, e.g. to benchmark against the replay server
+    return ChatCacheDB(config["cache"]) if config["cache"] != "" else None
 
-        msg = []
-        for match in matches:
-            jsonData = str(match.group(1))
-            try:
-                parsedData = json.loads(jsonData)
-                msg.append(parsedData['message'])
-            except:
-                continue
+def make_chat(config: Dict[str, str] | None = None) -> ChatBackend:
+    if config is None: config = get_config()
+    match config["backend"]:
+        case "duckchat":
+            return DuckChat(make_cache(config))
+        case "openai":
+            return OpenAIChat(config["api_base"], config["api_key"], config["model"], make_cache(config))
+    raise ValueError(f"Unknown chat backend: {config['backend']}")
 
-        return "".join(msg)
-    
 
 if __name__ == '__main__':
-    duck_chat = DuckChat()
+    chat = make_chat()
 
     while True:
         user_input = input("=> ")
         if user_input.lower() == 'exit':
             break
 
-        response_message = duck_chat.send_message(user_input)
-        print(response_message)
+        for piece in chat.stream_message(user_input):
+            print(piece, end="", flush=True)
+        print()
 
@@ -1,15 +1,30 @@
 import os
 import sys
+import time
+from typing import Callable
 from flowchartron.diagramMaker import FlowChart
-from flowchartron.chart_gen import DrawIOBrowser, cp
+from flowchartron.chart_gen import DrawIOScriptBrowser
 from flowchartron.elements_db import BlockStyleDB
+from flowchartron.renderer import NativeRenderer, render_svg
+from flowchartron.render_cache import CachedExporter, make_render_cache
 from flowchartron.xml_gen import generate_XML
+from flowchartron import ast_gen
 from flowchartron.window import Ui_MainWindow
 from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox, QFileDialog, QLabel, QProgressBar
 from PyQt5.QtGui import QPixmap, QImage
 from PyQt5.QtCore import QObject, QThread, pyqtSignal
 
+# seconds before "Повторять долгие запросы" starts a second request for the same chart
+HEDGE_DELAY = 20
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        from flowchartron.batch import batch_main
+        sys.exit(batch_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "mock-server":
+        from flowchartron.mock_server import server_main
+        sys.exit(server_main(sys.argv[2:]))
+
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
@@ -17,34 +32,41 @@ def main():
 
 class GPTWorker(QObject):
     finished = pyqtSignal(str)
+    failed = pyqtSignal(str)
     progress = pyqtSignal(int)
-    def __init__(self, program_source: str, progressBar: QProgressBar):
+    received = pyqtSignal(int)
+    def __init__(self, program_source: str, progressBar: QProgressBar, single_prompt: bool = False, hedge_delay: float | None = None):
         super().__init__()
         self.program_source = program_source,
         self.progressBar = progressBar
+        self.single_prompt = single_prompt
+        self.hedge_delay = hedge_delay
 
     def run(self):
         try:
-            xml = generate_XML(self.program_source[0], self.progress)
-        except:
+            xml = generate_XML(self.program_source[0], self.progress, self.single_prompt, self.received, self.hedge_delay)
+        except Exception as e:
+            self.failed.emit(str(e))
             xml = ""
         self.finished.emit(xml)
 
 class BrowserWorker(QObject):
-    finished = pyqtSignal()
+    finished = pyqtSignal(bytes)
     progress = pyqtSignal(int)
-    def __init__(self, browser: DrawIOBrowser, drawio_file: str, output_path: str):
+    def __init__(self, export: Callable[[str], bytes], drawio_flowchart: str):
         super().__init__()
-        self.browser = browser,
-        self.drawio_file = drawio_file,
-        self.output_path = output_path,
+        self.export = export,
+        self.drawio_flowchart = drawio_flowchart,
 
     def run(self):
+        # the compiled chart goes to the exporter as a string and the PNG comes back in memory
+        self.progress.emit(1)
         try:
-            self.browser[0].export_to_png(self.drawio_file[0], self.output_path[0], self.progress)
+            image = self.export[0](self.drawio_flowchart[0])
         except:
-            pass
-        self.finished.emit()
+            image = b""
+        self.progress.emit(3)
+        self.finished.emit(image)
 
 class MainWindow(QMainWindow, Ui_MainWindow):
     def __init__(self):
@@ -54,8 +76,20 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.imgScrollArea.setWidget(self.imageLabel)
 
         self.__flowchart__ = FlowChart()
-        self.__browser__ = DrawIOBrowser()
+        self.__browser__ = DrawIOScriptBrowser()
+        self.__renderer__ = NativeRenderer()
+        self.img_native = True
+        self.render_cache = make_render_cache()
+        # (XML, native) of the picture on screen and of the one being exported
+        self.rendered_key = None
+        self.render_key = None
+        # the .drawio and the PNG of the picture on screen, kept for saving
+        self.rendered_drawio = ""
+        self.render_drawio = ""
+        self.flowchartPNG = b""
+        self.flowchartQImage: QImage | None = None
         self.style_db = BlockStyleDB(os.path.join(self.__browser__._WORKING_DIRECTORY, "cool_db.db"))
+        self.xml_stage = ""
 
         self.XMLGenButton.clicked.connect(self.generate_XML)
         self.imgGenButton.clicked.connect(self.gen_img)
@@ -70,45 +104,69 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             msgBox.exec()
             return
 
+        self.xml_started = time.perf_counter()
+        self.xml_error = ""
+        if self.localGenCheckBox.isChecked():
+            self.xml_mode = "локально"
+            try:
+                xml = ast_gen.generate_XML(program_source)
+            except SyntaxError:
+                xml = ""
+            self.handle_generated_xml(xml)
+            return
+
         self.XMLGenButton.setEnabled(False)
         self.codeBlock.setEnabled(False)
 
         self.threadXML = QThread()
-        self.worker = GPTWorker(program_source, self.XMLGenProgressBar)
+        single_prompt = self.singlePromptCheckBox.isChecked()
+        hedge_delay = HEDGE_DELAY if self.hedgeCheckBox.isChecked() else None
+        self.xml_mode = "одним запросом" if single_prompt else "три запроса"
+        if hedge_delay is not None: self.xml_mode += ", с повтором"
+        self.worker = GPTWorker(program_source, self.XMLGenProgressBar, single_prompt, hedge_delay)
         self.worker.moveToThread(self.threadXML)
 
         self.threadXML.started.connect(self.worker.run)
+        self.worker.failed.connect(self.handle_xml_failed)
         self.worker.finished.connect(self.handle_generated_xml)
         self.worker.finished.connect(self.threadXML.quit)
         self.worker.progress.connect(self.handle_xml_progress)
+        self.worker.received.connect(self.handle_xml_received)
 
         self.threadXML.start()
 
     def handle_xml_progress(self, result: int):
         match result:
             case 0:
-                self.XMLGenProgressBar.setFormat("Ожидание действий пользователя...(%v/%m)")
+                self.xml_stage = "Ожидание действий пользователя..."
             case 1:
-                self.XMLGenProgressBar.setFormat("Запрос базовой диаграммы...(%v/%m)")
+                self.xml_stage = "Запрос базовой диаграммы..."
             case 2:
-                self.XMLGenProgressBar.setFormat("Украшение блоков...(%v/%m)")
+                self.xml_stage = "Украшение блоков..."
             case 3:
-                self.XMLGenProgressBar.setFormat("Перевод в естественный язык...(%v/%m)")
-            case 4:
-                self.XMLGenProgressBar.setFormat("Перевод на русский...(%v/%m)")
+                self.xml_stage = "Сокращение и перевод подписей..."
             case 5:
-                self.XMLGenProgressBar.setFormat("Исправление XML...(%v/%m)")
+                self.xml_stage = "Исправление XML..."
 
+        self.XMLGenProgressBar.setFormat(f"{self.xml_stage}(%v/%m)")
         self.XMLGenProgressBar.setValue(result)
 
+    def handle_xml_received(self, length: int):
+        self.XMLGenProgressBar.setFormat(f"{self.xml_stage}получено {length} симв. (%v/%m)")
+
+    def handle_xml_failed(self, error: str):
+        self.xml_error = error
+
     def handle_generated_xml(self, result: str):
         self.codeBlock.setEnabled(True)
         self.XMLGenButton.setEnabled(True)
+        self.statusbar.showMessage(f"XML ({self.xml_mode}): {time.perf_counter() - self.xml_started:.2f} с")
         print(result)
 
         if result == "":
             msgBox = QMessageBox(self)
             msgBox.setText("Не удалось сгенерировать XML")
+            if self.xml_error: msgBox.setInformativeText(self.xml_error)
             msgBox.exec()
             return
         try:
@@ -122,8 +180,17 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         self.XMLBlock.setPlainText(result)
 
+    def closeEvent(self, event):
+        # the warm draw.io browser would otherwise outlive the window
+        self.__browser__.close()
+        super().closeEvent(event)
+
     def gen_img(self):
         xml = self.XMLBlock.toPlainText()
+        self.render_key = (xml, self.nativeRenderCheckBox.isChecked())
+        if self.render_key == self.rendered_key and self.flowchartQImage is not None:
+            return
+
         try:
             self.__flowchart__.parse_XML(xml, self.style_db)
         except:
@@ -136,17 +203,25 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.imgGenButton.setEnabled(False)
         self.XMLBlock.setEnabled(False)
 
-        self.tmpfile = os.path.join(self.__browser__._WORKING_DIRECTORY, "tmp.drawio")
-        self.png_path = os.path.join(self.__browser__._WORKING_DIRECTORY, "output.png")
+        self.render_drawio = self.__flowchart__.chart_compile(self.style_db)
 
-        self.__flowchart__.parse_XML(xml, self.style_db)
-        drawio_flowchart = self.__flowchart__.chart_compile(self.style_db)
+        # the native renderer draws the same cells locally, draw.io is only needed for its exact look
+        self.img_native = self.nativeRenderCheckBox.isChecked()
+        exporter = self.__renderer__ if self.img_native else self.__browser__
+        export = exporter.export_diagram
 
-        with open(self.tmpfile, "w") as F:
-            F.write(drawio_flowchart)
+        if self.render_cache is not None:
+            exporter = CachedExporter(exporter, self.render_cache)
+            image = exporter.get_cached(self.render_drawio)
+            if image is not None:
+                self.handle_img_progress(3)
+                self.handle_generated_img(image)
+                return
+            # the lookup is done, the worker only exports and fills the cache
+            export = exporter.export_uncached
 
         self.threadPNG = QThread()
-        self.worker = BrowserWorker(self.__browser__, self.tmpfile, self.png_path)
+        self.worker = BrowserWorker(export, self.render_drawio)
         self.worker.moveToThread(self.threadPNG)
 
         self.threadPNG.started.connect(self.worker.run)
@@ -160,32 +235,40 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         match result:
             case 0:
                 self.XMLGenProgressBar.setFormat("Ожидание действий пользователя...(%v/%m)")
+            case 1 if self.img_native:
+                self.imgGenProgressBar.setFormat("Рисование блок-схемы...(%v/%m)")
             case 1:
-                self.imgGenProgressBar.setFormat("Открытие draw.io...(%v/%m)")
-            case 2:
-                self.imgGenProgressBar.setFormat("Выгрузка файла .drawio...(%v/%m)")
+                self.imgGenProgressBar.setFormat("Рисование в draw.io...(%v/%m)")
             case 3:
-                self.imgGenProgressBar.setFormat("Загрузка файла...(%v/%m)")
+                self.imgGenProgressBar.setFormat("Готово (%v/%m)")
         self.imgGenProgressBar.setValue(result)
 
-    def handle_generated_img(self):
+    def handle_generated_img(self, image: bytes):
         self.imgGenButton.setEnabled(True)
         self.XMLBlock.setEnabled(True)
 
-        if not os.path.exists(self.png_path):
+        flowchartQImage = QImage.fromData(image, "PNG")
+        if flowchartQImage.isNull():
+            # a failed export must not leave the previous picture behind
             msgBox = QMessageBox()
             msgBox.setText("Не удалось экспортировать блок-схему")
             msgBox.exec()
             self.imgGenProgressBar.setFormat("Ожидание действий пользователя...(%p/%m)")
+            self.rendered_key = None
+            self.rendered_drawio = ""
+            self.flowchartPNG = b""
+            self.flowchartQImage = None
+            self.imageLabel.clear()
+            return
 
-        flowchartQImage = QImage(self.png_path)
-        self.imageLabel.setPixmap(QPixmap.fromImage(flowchartQImage))
+        self.flowchartQImage = flowchartQImage
+        self.flowchartPNG = image
+        self.rendered_key = self.render_key
+        self.rendered_drawio = self.render_drawio
+        self.imageLabel.setPixmap(QPixmap.fromImage(self.flowchartQImage))
 
     def save_file(self):
-        tmpfile = os.path.join(self.__browser__._WORKING_DIRECTORY, "tmp.drawio")
-        png_path = os.path.join(self.__browser__._WORKING_DIRECTORY, "output.png")
-
-        if not os.path.isfile(png_path):
+        if self.flowchartQImage is None:
             msgBox = QMessageBox(self)
             msgBox.setText("Сгенерируйте изображение!")
             msgBox.exec()
@@ -196,29 +279,32 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                 self, 
                 'Save File', 
                 '', 
-                'draw.io Files (*.drawio);;Images (*.png)', 
+                'draw.io Files (*.drawio);;Images (*.png);;Vector images (*.svg)', 
                 options=options
                 )
 
         if output_path:
             extension = output_path.split(os.extsep)[-1]
             if extension == "drawio":
-                cp(tmpfile, output_path)
+                with open(output_path, "w", encoding="utf-8") as F:
+                    F.write(self.rendered_drawio)
             if extension == "png":
-                cp(png_path, output_path)
+                with open(output_path, "wb") as F:
+                    F.write(self.flowchartPNG)
+            if extension == "svg":
+                with open(output_path, "w", encoding="utf-8") as F:
+                    F.write(render_svg(self.rendered_drawio))
 
     def clipboard(self):
-        png_path = os.path.join(self.__browser__._WORKING_DIRECTORY, "output.png")
-
-        if not os.path.isfile(png_path):
+        if self.flowchartQImage is None:
             msgBox = QMessageBox(self)
             msgBox.setText("Сгенерируйте изображение!")
             msgBox.exec()
             return
 
-        image = QImage(png_path)
+        # the picture on screen is already decoded
         clipboard = QApplication.clipboard()
-        clipboard.setImage(image)
+        clipboard.setImage(self.flowchartQImage)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,149 @@
+import argparse, json, sqlite3, sys, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from flowchartron.chat_cache import ChatCacheDB
+
+# a stand-in for the chat model: answers OpenAI style /chat/completions requests
+# with the responses recorded in a chat cache, after a fixed delay
+
+def load_recordings(cache_path: str) -> Dict[str, str]:
+    # ChatCacheDB key -> response, read once so the handler threads don't share the sqlite connection
+    con = sqlite3.connect(cache_path)
+    try:
+        return dict(con.execute('''SELECT key, response FROM RESPONSES''').fetchall())
+    finally:
+        con.close()
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self,
+                 address: tuple,
+                 recordings: Dict[str, str],
+                 latency: float = 0,
+                 chunk_delay: float = 0,
+                 chunk_size: int = 16,
+                 ):
+        super().__init__(address, MockHandler)
+        self.recordings = recordings
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+
+    def handle_error(self, request, client_address):
+        # clients dropping a kept-alive connection is normal, not worth a traceback
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)): return
+        super().handle_error(request, client_address)
+
+    def find_response(self, model: str, prompt: str) -> str | None:
+        return self.recordings.get(ChatCacheDB.get_key(model, prompt))
+
+    def split_response(self, response: str) -> List[str]:
+        return [response[i:i + self.chunk_size] for i in range(0, len(response), self.chunk_size)]
+
+class MockHandler(BaseHTTPRequestHandler):
+    server: MockServer
+    # keeps connections alive like the real endpoints, streams are sent chunked
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        request_body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        try:
+            request = json.loads(request_body)
+            model = request.get("model", "")
+            prompt = request["messages"][-1]["content"]
+        except (ValueError, KeyError, IndexError, TypeError):
+            self.send_json(400, {"error": {"message": "Malformed chat request"}})
+            return
+
+        response = self.server.find_response(model, prompt)
+        if response is None:
+            self.send_json(404, {"error": {"message": "No recorded response for this prompt"}})
+            return
+
+        time.sleep(self.server.latency)
+        if request.get("stream", False):
+            self.send_stream(model, response)
+        else:
+            self.send_json(200, {
+                "object": "chat.completion",
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": response}, "finish_reason": "stop"}],
+                })
+
+    def send_json(self, status: int, body: dict):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, model: str, response: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        try:
+            for piece in self.server.split_response(response):
+                chunk = {
+                        "object": "chat.completion.chunk",
+                        "model": model,
+                        "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+                        }
+                self.send_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+                time.sleep(self.server.chunk_delay)
+            self.send_chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stops reading as soon as it has the whole XML block
+            self.close_connection = True
+
+    def send_chunk(self, text: str):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format: str, *args):
+        print(f"{self.address_string()} {format % args}", file=sys.stderr)
+
+def server_main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+            prog="flowchartron mock-server",
+            description="Replay recorded chat responses through an OpenAI compatible API, for offline tests and benchmarks."
+            )
+    parser.add_argument("recordings", help="chat cache to replay (chat_cache.db is filled by every run with the cache on)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0, help="seconds before the first byte of every reply (default: 0)")
+    parser.add_argument("--chunk-delay", type=float, default=0, help="seconds between streamed chunks (default: 0)")
+    parser.add_argument("--chunk-size", type=int, default=16, help="characters per streamed chunk (default: 16)")
+    args = parser.parse_args(argv)
+
+    server = MockServer(
+            (args.host, args.port),
+            load_recordings(args.recordings),
+            args.latency,
+            args.chunk_delay,
+            max(args.chunk_size, 1)
+            )
+    print(
+            f"Replaying {len(server.recordings)} responses on http://{args.host}:{server.server_port}/v1, "
+            f"use FLOWCHARTRON_BACKEND=openai FLOWCHARTRON_API_BASE=http://{args.host}:{server.server_port}/v1 FLOWCHARTRON_CHAT_CACHE=",
+            file=sys.stderr
+            )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(server_main(sys.argv[1:]))
@@ -0,0 +1,89 @@
+import hashlib, os, sqlite3, threading, time
+from flowchartron.chat_cache import evict_lru
+
+class RenderCacheDB:
+    # rendered images keyed by the compiled .drawio and the export options, so an unchanged chart is never exported twice
+    def __init__(self, file_name: str, max_bytes: int = 256 * 1024 * 1024):
+        # exports run on worker threads in the GUI
+        self.con = sqlite3.connect(file_name, timeout=30, check_same_thread=False)
+        self.cur = self.con.cursor()
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self.cur.execute(f'''CREATE TABLE IF NOT EXISTS IMAGES (key TEXT PRIMARY KEY, options TEXT, image BLOB, size INTEGER, created REAL, last_used REAL)''')
+        self.cur.execute(f'''CREATE INDEX IF NOT EXISTS IMAGES_LAST_USED ON IMAGES (last_used)''')
+        self.con.commit()
+
+    def __del__(self):
+        self.con.close()
+
+    @staticmethod
+    def get_key(document: str, options: str) -> str:
+        return hashlib.sha256(f"{options}\0{document}".encode("utf-8")).hexdigest()
+
+    def get_image(self, document: str, options: str) -> bytes | None:
+        key = self.get_key(document, options)
+        with self.lock:
+            self.cur.execute(f'''SELECT image FROM IMAGES WHERE key = ?''', (key,))
+            row = self.cur.fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.cur.execute(f'''UPDATE IMAGES SET last_used = ? WHERE key = ?''', (time.time(), key))
+            self.con.commit()
+            self.hits += 1
+            return bytes(row[0])
+
+    def add_image(self, document: str, options: str, image: bytes):
+        now = time.time()
+        with self.lock:
+            self.cur.execute(
+                    f'''INSERT OR REPLACE INTO IMAGES (key, options, image, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?)''',
+                    (self.get_key(document, options), options, image, len(image), now, now)
+                    )
+            self.evict()
+            self.con.commit()
+
+    def evict(self):
+        evict_lru(self.cur, "IMAGES", self.max_bytes)
+
+    def clear(self):
+        with self.lock:
+            self.cur.execute(f'''DELETE FROM IMAGES''')
+            self.con.commit()
+
+def make_render_cache(default_path: str = "render_cache.db") -> RenderCacheDB | None:
+    # an empty path turns the image cache off, like FLOWCHARTRON_CHAT_CACHE
+    path = os.environ.get("FLOWCHARTRON_RENDER_CACHE", default_path)
+    return RenderCacheDB(path) if path != "" else None
+
+def get_render_options(exporter, format: str = "png", page: int = 0) -> str:
+    # the same chart looks different through another exporter or at another scale
+    return f"{type(exporter).__name__};{format};scale={getattr(exporter, 'scale', 1)};page={page}"
+
+class CachedExporter:
+    # wraps NativeRenderer or a DrawIOBrowser and skips the export for cached charts
+    def __init__(self, exporter, cache: RenderCacheDB):
+        self.exporter = exporter
+        self.cache = cache
+
+    def get_cached(self, xml: str, format: str = "png", page: int = 0) -> bytes | None:
+        return self.cache.get_image(xml, get_render_options(self.exporter, format, page))
+
+    def export_uncached(self, xml: str, format: str = "png", page: int = 0) -> bytes:
+        # exports and caches without looking up first, for callers that already missed with get_cached
+        image = self.exporter.export_diagram(xml, format, page)
+        self.cache.add_image(xml, get_render_options(self.exporter, format, page), image)
+        return image
+
+    def export_diagram(self, xml: str, format: str = "png", page: int = 0) -> bytes:
+        image = self.get_cached(xml, format, page)
+        if image is None:
+            image = self.export_uncached(xml, format, page)
+        return image
+
+    def close(self):
+        if hasattr(self.exporter, "close"): self.exporter.close()
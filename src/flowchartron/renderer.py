@@ -0,0 +1,462 @@
+import math, os
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Tuple
+from flowchartron.diagramMaker import TEXT_ESCAPES, decompress_diagram, escape_attrib
+
+# draws a compiled .drawio chart without draw.io: the cells already carry every shape,
+# position and edge, SVG is written as plain text and PNG is painted with Qt
+
+FONT_FAMILY = "GOST"
+FONT_SIZE = 12
+LINE_HEIGHT = 1.2
+# average glyph width relative to the font size, SVG has no way to measure text
+GLYPH_WIDTH = 0.55
+LABEL_SPACING = 4
+STROKE_WIDTH = 2
+ARROW_LENGTH = 10
+ARROW_HALF_WIDTH = 3
+MARGIN = 10
+
+Point = Tuple[float, float]
+# ("M", x, y), ("L", x, y), ("Q", control x, control y, x, y) or ("Z",)
+PathCommand = Tuple
+
+class Vertex:
+    def __init__(self, x: float, y: float, width: float, height: float, label: str, style: Dict[str, str]):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.label = label
+        self.style = style
+
+    def is_point(self) -> bool:
+        return self.width == 0 and self.height == 0
+
+    def center(self) -> Point:
+        return (self.x + self.width / 2, self.y + self.height / 2)
+
+class Edge:
+    def __init__(self, source: str, target: str, label: str, points: List[Point], end_arrow: bool):
+        self.source = source
+        self.target = target
+        self.label = label
+        self.points = points
+        self.end_arrow = end_arrow
+
+class Drawing:
+    # what both backends paint, in painting order
+    def __init__(self):
+        self.paths: List[Tuple[List[PathCommand], str]] = []
+        # (center x, center y, width, label, on a white background)
+        self.texts: List[Tuple[float, float, float, str, bool]] = []
+        self.bounds = [math.inf, math.inf, -math.inf, -math.inf]
+
+    def include(self, x: float, y: float):
+        self.bounds = [min(self.bounds[0], x), min(self.bounds[1], y), max(self.bounds[2], x), max(self.bounds[3], y)]
+
+    def add_path(self, commands: List[PathCommand], fill: str = "none"):
+        self.paths.append((commands, fill))
+        for command in commands:
+            if len(command) > 1: self.include(command[-2], command[-1])
+
+    def add_text(self, x: float, y: float, width: float, label: str, background: bool = False):
+        if label == "": return
+        self.texts.append((x, y, width, label, background))
+        lines = wrap_label(label, width)
+        text_width = max(text_width_estimate(line) for line in lines)
+        text_height = len(lines) * FONT_SIZE * LINE_HEIGHT
+        self.include(x - text_width / 2, y - text_height / 2)
+        self.include(x + text_width / 2, y + text_height / 2)
+
+    def get_viewbox(self) -> Tuple[float, float, float, float]:
+        if self.bounds[0] == math.inf: return (0, 0, 2 * MARGIN, 2 * MARGIN)
+        x0, y0, x1, y1 = self.bounds
+        return (x0 - MARGIN, y0 - MARGIN, x1 - x0 + 2 * MARGIN, y1 - y0 + 2 * MARGIN)
+
+def parse_style(style: str) -> Dict[str, str]:
+    entries: Dict[str, str] = {}
+    for entry in style.split(";"):
+        key, _, value = entry.partition("=")
+        if key != "": entries[key] = value
+    return entries
+
+def get_graph_model(document: str, page: int = 0) -> ET.Element:
+    root = ET.fromstring(document)
+    if root.tag == "mxGraphModel": return root
+
+    diagram = root.findall("diagram")[page]
+    model = diagram.find("mxGraphModel")
+    if model is None:
+        model = ET.fromstring(decompress_diagram((diagram.text or "").strip()))
+    return model
+
+def read_cells(document: str, page: int = 0) -> Tuple[Dict[str, Vertex], List[Edge]]:
+    vertices: Dict[str, Vertex] = {}
+    edges: List[Edge] = []
+
+    for cell in get_graph_model(document, page).iter("mxCell"):
+        geometry = cell.find("mxGeometry")
+        if geometry is None: continue
+        style = parse_style(cell.get("style", ""))
+
+        if cell.get("vertex") == "1":
+            vertices[cell.get("id")] = Vertex(
+                    float(geometry.get("x", 0)),
+                    float(geometry.get("y", 0)),
+                    float(geometry.get("width", 0)),
+                    float(geometry.get("height", 0)),
+                    cell.get("value", ""),
+                    style
+                    )
+        elif cell.get("edge") == "1":
+            points_array = geometry.find("Array[@as='points']")
+            points = [] if points_array is None else [
+                    (float(point.get("x", 0)), float(point.get("y", 0))) for point in points_array.iter("mxPoint")
+                    ]
+            edges.append(Edge(
+                cell.get("source", ""),
+                cell.get("target", ""),
+                cell.get("value", ""),
+                points,
+                style.get("endArrow", "classic") != "none"
+                ))
+
+    return vertices, edges
+
+def get_size(style: Dict[str, str], default: float) -> float:
+    try:
+        return float(style["size"])
+    except (KeyError, ValueError):
+        return default
+
+def polygon(points: List[Point]) -> List[PathCommand]:
+    commands: List[PathCommand] = [("M", *points[0])]
+    commands.extend(("L", *point) for point in points[1:])
+    commands.append(("Z",))
+    return commands
+
+def shape_commands(width: float, height: float, style: Dict[str, str]) -> List[List[PathCommand]]:
+    # the outline of a block in its own coordinates, plus any inner lines, the way draw.io draws the shape
+    w, h = width, height
+    match style.get("shape", ""):
+        case "display":
+            dx = w * get_size(style, 0.25)
+            return [[
+                ("M", 0, h / 2), ("L", dx, 0), ("L", w - dx, 0),
+                ("Q", w, 0, w, h / 2), ("Q", w, h, w - dx, h),
+                ("L", dx, h), ("Z",)
+                ]]
+        case "manualInput":
+            dy = min(h, get_size(style, 30))
+            return [polygon([(0, dy), (w, 0), (w, h), (0, h)])]
+        case "process":
+            dx = w * get_size(style, 0.1)
+            return [
+                    polygon([(0, 0), (w, 0), (w, h), (0, h)]),
+                    [("M", dx, 0), ("L", dx, h)],
+                    [("M", w - dx, 0), ("L", w - dx, h)],
+                    ]
+        case "hexagon":
+            dx = w * get_size(style, 0.25)
+            return [polygon([(dx, 0), (w - dx, 0), (w, h / 2), (w - dx, h), (dx, h), (0, h / 2)])]
+        case "parallelogram":
+            dx = w * get_size(style, 0.2)
+            return [polygon([(0, h), (dx, 0), (w, 0), (w - dx, h)])]
+        case "mxgraph.flowchart.decision":
+            return [polygon([(w / 2, 0), (w, h / 2), (w / 2, h), (0, h / 2)])]
+        case "loopLimit":
+            s = min(w / 2, h / 2, get_size(style, 20))
+            return [polygon([(s, 0), (w - s, 0), (w, s), (w, h), (0, h), (0, s)])]
+
+    if style.get("rounded") == "1":
+        arc = float(style.get("arcSize", 10))
+        r = min(w / 2, h / 2, arc / 2 if style.get("absoluteArcSize") == "1" else min(w, h) * arc / 100)
+        return [[
+            ("M", r, 0), ("L", w - r, 0), ("Q", w, 0, w, r),
+            ("L", w, h - r), ("Q", w, h, w - r, h),
+            ("L", r, h), ("Q", 0, h, 0, h - r),
+            ("L", 0, r), ("Q", 0, 0, r, 0), ("Z",)
+            ]]
+    return [polygon([(0, 0), (w, 0), (w, h), (0, h)])]
+
+def place_shape(vertex: Vertex) -> List[List[PathCommand]]:
+    # shapes are drawn facing east, other directions rotate them inside the same box
+    direction = vertex.style.get("direction", "east")
+    w, h = vertex.width, vertex.height
+    if direction in ("north", "south"):
+        outlines = shape_commands(h, w, vertex.style)
+    else:
+        outlines = shape_commands(w, h, vertex.style)
+
+    def transform(x: float, y: float) -> Point:
+        match direction:
+            case "west":
+                x, y = w - x, h - y
+            case "south":
+                x, y = w - y, x
+            case "north":
+                x, y = y, h - x
+        return (vertex.x + x, vertex.y + y)
+
+    placed: List[List[PathCommand]] = []
+    for outline in outlines:
+        commands: List[PathCommand] = []
+        for command in outline:
+            coordinates = [transform(command[i], command[i + 1]) for i in range(1, len(command), 2)]
+            commands.append((command[0], *[value for point in coordinates for value in point]))
+        placed.append(commands)
+    return placed
+
+def exit_point(vertex: Vertex, toward: Point) -> Tuple[Point, bool]:
+    # where an edge leaves (or enters) the block on its way to toward, and whether that side is vertical
+    if vertex.is_point(): return (vertex.x, vertex.y), True
+    cx, cy = vertex.center()
+    if vertex.y < toward[1] < vertex.y + vertex.height:
+        return (vertex.x + vertex.width if toward[0] > cx else vertex.x, toward[1]), False
+    if toward[1] >= vertex.y + vertex.height:
+        return (cx, vertex.y + vertex.height), True
+    return (cx, vertex.y), True
+
+def orthogonal(a: Point, b: Point, vertical_first: bool) -> List[Point]:
+    if a[0] == b[0] or a[1] == b[1]: return [a, b]
+    return [a, (a[0], b[1]) if vertical_first else (b[0], a[1]), b]
+
+def route_edge(source: Vertex, target: Vertex, waypoints: List[Point]) -> List[Point]:
+    # orthogonalEdgeStyle: straight segments through the waypoints, leaving and entering the blocks squarely
+    if not waypoints:
+        start, _ = exit_point(source, target.center())
+        end, _ = exit_point(target, start)
+        if start[0] == end[0] or start[1] == end[1]:
+            route = [start, end]
+        else:
+            middle = (start[1] + end[1]) / 2
+            route = [start, (start[0], middle), (end[0], middle), end]
+    else:
+        start, vertical = exit_point(source, waypoints[0])
+        route = orthogonal(start, waypoints[0], vertical)
+        for a, b in zip(waypoints, waypoints[1:]):
+            route.extend(orthogonal(a, b, True)[1:])
+        end, vertical = exit_point(target, waypoints[-1])
+        # come in along the side the edge enters through
+        route.extend(orthogonal(waypoints[-1], end, not vertical or target.is_point())[1:])
+
+    deduplicated = [route[0]]
+    for point in route[1:]:
+        if point != deduplicated[-1]: deduplicated.append(point)
+    return deduplicated
+
+def route_midpoint(route: List[Point]) -> Point:
+    # draw.io puts edge labels halfway along the edge
+    lengths = [math.dist(a, b) for a, b in zip(route, route[1:])]
+    remaining = sum(lengths) / 2
+    for (a, b), length in zip(zip(route, route[1:]), lengths):
+        if remaining <= length and length > 0:
+            t = remaining / length
+            return (a[0] + (b[0] - a[0]) * t, a[1] + (b[1] - a[1]) * t)
+        remaining -= length
+    return route[-1]
+
+def arrowhead(a: Point, b: Point) -> List[PathCommand]:
+    length = math.dist(a, b)
+    if length == 0: return []
+    ux, uy = (b[0] - a[0]) / length, (b[1] - a[1]) / length
+    bx, by = b[0] - ux * ARROW_LENGTH, b[1] - uy * ARROW_LENGTH
+    return polygon([b, (bx - uy * ARROW_HALF_WIDTH, by + ux * ARROW_HALF_WIDTH), (bx + uy * ARROW_HALF_WIDTH, by - ux * ARROW_HALF_WIDTH)])
+
+def text_width_estimate(text: str) -> float:
+    return len(text) * FONT_SIZE * GLYPH_WIDTH
+
+def wrap_label(label: str, width: float) -> List[str]:
+    # greedy word wrap with estimated glyph widths, words longer than a line are split
+    max_chars = max(1, int(width / (FONT_SIZE * GLYPH_WIDTH)))
+    lines: List[str] = []
+    for paragraph in label.split("\n"):
+        line = ""
+        for word in paragraph.split(" "):
+            while len(word) > max_chars:
+                if line != "":
+                    lines.append(line)
+                    line = ""
+                lines.append(word[:max_chars])
+                word = word[max_chars:]
+            candidate = word if line == "" else f"{line} {word}"
+            if len(candidate) > max_chars and line != "":
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+def draw_chart(document: str, page: int = 0) -> Drawing:
+    vertices, edges = read_cells(document, page)
+    drawing = Drawing()
+
+    arrows: List[List[PathCommand]] = []
+    edge_labels: List[Tuple[Point, str]] = []
+    for edge in edges:
+        if edge.source not in vertices or edge.target not in vertices: continue
+        route = route_edge(vertices[edge.source], vertices[edge.target], edge.points)
+        if len(route) < 2: continue
+
+        commands: List[PathCommand] = [("M", *route[0])]
+        commands.extend(("L", *point) for point in route[1:])
+        drawing.add_path(commands)
+        if edge.end_arrow: arrows.append(arrowhead(route[-2], route[-1]))
+        edge_labels.append((route_midpoint(route), edge.label))
+
+    for arrow in arrows:
+        if arrow: drawing.add_path(arrow, "#ffffff")
+
+    # blocks are filled, so they cover the ends of the edges like in draw.io
+    for vertex in vertices.values():
+        if vertex.is_point(): continue
+        outline, *lines = place_shape(vertex)
+        drawing.add_path(outline, "#ffffff")
+        for line in lines: drawing.add_path(line)
+
+    for vertex in vertices.values():
+        if vertex.is_point(): continue
+        cx, cy = vertex.center()
+        drawing.add_text(cx, cy, vertex.width - 2 * LABEL_SPACING, vertex.label)
+    for (x, y), label in edge_labels:
+        drawing.add_text(x, y, 200, label, True)
+
+    return drawing
+
+def path_data(commands: List[PathCommand]) -> str:
+    return " ".join(command[0] + "".join(f" {value:g}" for value in command[1:]) for command in commands)
+
+def render_svg(document: str, page: int = 0) -> str:
+    drawing = draw_chart(document, page)
+    x0, y0, width, height = drawing.get_viewbox()
+
+    parts = [
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:g}" height="{height:g}" viewBox="{x0:g} {y0:g} {width:g} {height:g}">',
+            f'<rect x="{x0:g}" y="{y0:g}" width="{width:g}" height="{height:g}" fill="#ffffff"/>',
+            f'<g stroke="#000000" stroke-width="{STROKE_WIDTH}" stroke-linejoin="miter">',
+            ]
+    for commands, fill in drawing.paths:
+        parts.append(f'<path d="{path_data(commands)}" fill="{fill}"/>')
+    parts.append("</g>")
+
+    parts.append(f'<g font-family="{escape_attrib(FONT_FAMILY)}, sans-serif" font-size="{FONT_SIZE}" text-anchor="middle" fill="#000000">')
+    for x, y, width, label, background in drawing.texts:
+        lines = wrap_label(label, width)
+        line_height = FONT_SIZE * LINE_HEIGHT
+        top = y - len(lines) * line_height / 2
+        if background:
+            text_width = max(text_width_estimate(line) for line in lines)
+            parts.append(f'<rect x="{x - text_width / 2:g}" y="{top:g}" width="{text_width:g}" height="{len(lines) * line_height:g}" fill="#ffffff"/>')
+        # baselines sit a bit below the middle of every line
+        tspans = "".join(
+                f'<tspan x="{x:g}" y="{top + (i + 0.5) * line_height + FONT_SIZE * 0.35:g}">{line.translate(TEXT_ESCAPES)}</tspan>'
+                for i, line in enumerate(lines)
+                )
+        parts.append(f"<text>{tspans}</text>")
+    parts.append("</g>")
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+qt_application = None
+
+def draw_image(document: str, scale: float = 1, page: int = 0) -> "QImage":
+    # Qt is already there for the GUI, it only needs an application object to load fonts
+    from PyQt5.QtCore import QPointF, QRectF, Qt
+    from PyQt5.QtGui import QColor, QFont, QGuiApplication, QImage, QPainter, QPainterPath, QPen
+
+    global qt_application
+    if QGuiApplication.instance() is None:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        qt_application = QGuiApplication([])
+
+    drawing = draw_chart(document, page)
+    x0, y0, width, height = drawing.get_viewbox()
+
+    image = QImage(max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale)), QImage.Format_ARGB32)
+    image.fill(QColor("#ffffff"))
+
+    painter = QPainter(image)
+    painter.setRenderHint(QPainter.Antialiasing)
+    painter.setRenderHint(QPainter.TextAntialiasing)
+    painter.scale(scale, scale)
+    painter.translate(-x0, -y0)
+
+    pen = QPen(QColor("#000000"))
+    pen.setWidthF(STROKE_WIDTH)
+    pen.setJoinStyle(Qt.MiterJoin)
+    painter.setPen(pen)
+
+    for commands, fill in drawing.paths:
+        path = QPainterPath()
+        for command in commands:
+            match command[0]:
+                case "M":
+                    path.moveTo(command[1], command[2])
+                case "L":
+                    path.lineTo(command[1], command[2])
+                case "Q":
+                    path.quadTo(QPointF(command[1], command[2]), QPointF(command[3], command[4]))
+                case "Z":
+                    path.closeSubpath()
+        if fill != "none":
+            painter.fillPath(path, QColor(fill))
+        painter.drawPath(path)
+
+    font = QFont(FONT_FAMILY)
+    font.setPixelSize(FONT_SIZE)
+    painter.setFont(font)
+    flags = Qt.AlignCenter | Qt.TextWordWrap
+    for x, y, text_width, label, background in drawing.texts:
+        # a tall box around the anchor, Qt centres and wraps the label inside it
+        box = painter.boundingRect(QRectF(x - text_width / 2, y - height, text_width, 2 * height), flags, label)
+        if background:
+            painter.fillRect(box, QColor("#ffffff"))
+        painter.drawText(box, flags, label)
+
+    painter.end()
+    return image
+
+def render_png(document: str, output_path: str, scale: float = 1, page: int = 0):
+    if not draw_image(document, scale, page).save(output_path, "PNG"):
+        raise OSError(f"Could not write {output_path}")
+
+def render_png_data(document: str, scale: float = 1, page: int = 0) -> bytes:
+    from PyQt5.QtCore import QBuffer, QIODevice
+
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+    if not draw_image(document, scale, page).save(buffer, "PNG"):
+        raise OSError("Could not encode the PNG")
+    return bytes(buffer.data())
+
+def export_svg(drawio_file: str, output_path: str, page: int = 0):
+    with open(drawio_file, encoding="utf-8") as F:
+        document = F.read()
+    with open(output_path, "w", encoding="utf-8") as F:
+        F.write(render_svg(document, page))
+
+class NativeRenderer:
+    # drop-in for chart_gen.DrawIOBrowser: same export_to_png, no browser and no network
+    def __init__(self, scale: float = 1):
+        self.scale = scale
+
+    def export_to_png(self, drawio_file: str, output_path: str, progress_signal):
+        if not os.path.exists(drawio_file):
+            raise FileNotFoundError(drawio_file)
+        if os.path.isdir(output_path):
+            output_path = os.path.join(output_path, "output.png")
+
+        progress_signal.emit(1)
+        with open(drawio_file, encoding="utf-8") as F:
+            document = F.read()
+        progress_signal.emit(2)
+        render_png(document, output_path, self.scale)
+        progress_signal.emit(3)
+
+    def export_diagram(self, xml: str, format: str = "png", page: int = 0) -> bytes:
+        # xml is a .drawio document like FlowChart.chart_compile returns, format is png or svg
+        if format == "svg":
+            return render_svg(xml, page).encode("utf-8")
+        return render_png_data(xml, self.scale, page)
@@ -37,6 +37,16 @@ class Ui_MainWindow(object):
         self.XMLGenProgressBar.setProperty("value", 0)
         self.XMLGenProgressBar.setObjectName("XMLGenProgressBar")
         self.verticalLayout.addWidget(self.XMLGenProgressBar)
+        self.localGenCheckBox = QtWidgets.QCheckBox(self.groupBox)
+        self.localGenCheckBox.setObjectName("localGenCheckBox")
+        self.verticalLayout.addWidget(self.localGenCheckBox)
+        self.singlePromptCheckBox = QtWidgets.QCheckBox(self.groupBox)
+        self.singlePromptCheckBox.setChecked(True)
+        self.singlePromptCheckBox.setObjectName("singlePromptCheckBox")
+        self.verticalLayout.addWidget(self.singlePromptCheckBox)
+        self.hedgeCheckBox = QtWidgets.QCheckBox(self.groupBox)
+        self.hedgeCheckBox.setObjectName("hedgeCheckBox")
+        self.verticalLayout.addWidget(self.hedgeCheckBox)
         self.XMLGenButton = QtWidgets.QPushButton(self.groupBox)
         self.XMLGenButton.setObjectName("XMLGenButton")
         self.verticalLayout.addWidget(self.XMLGenButton)
@@ -56,6 +66,10 @@ class Ui_MainWindow(object):
         self.imgGenProgressBar.setProperty("value", 0)
         self.imgGenProgressBar.setObjectName("imgGenProgressBar")
         self.verticalLayout_2.addWidget(self.imgGenProgressBar)
+        self.nativeRenderCheckBox = QtWidgets.QCheckBox(self.groupBox_3)
+        self.nativeRenderCheckBox.setChecked(True)
+        self.nativeRenderCheckBox.setObjectName("nativeRenderCheckBox")
+        self.verticalLayout_2.addWidget(self.nativeRenderCheckBox)
         self.imgGenButton = QtWidgets.QPushButton(self.groupBox_3)
         self.imgGenButton.setEnabled(True)
         self.imgGenButton.setMouseTracking(False)
@@ -106,10 +120,14 @@ class Ui_MainWindow(object):
         self.groupBox.setTitle(_translate("MainWindow", "Ввод кода"))
         self.codeBlock.setPlaceholderText(_translate("MainWindow", "Введите метод или функцию"))
         self.XMLGenProgressBar.setFormat(_translate("MainWindow", "Ожидание действий пользователя...(%p/%m)"))
+        self.localGenCheckBox.setText(_translate("MainWindow", "Без нейросети (только Python)"))
+        self.singlePromptCheckBox.setText(_translate("MainWindow", "Одним запросом к нейросети"))
+        self.hedgeCheckBox.setText(_translate("MainWindow", "Повторять долгие запросы"))
         self.XMLGenButton.setText(_translate("MainWindow", "Сгенерировать XML"))
         self.groupBox_3.setTitle(_translate("MainWindow", "XML Блок-схемы"))
         self.XMLBlock.setPlaceholderText(_translate("MainWindow", "Нажмите кнопку \"Сгенерировать XML\""))
         self.imgGenProgressBar.setFormat(_translate("MainWindow", "Ожидание действий пользователя...(%p/%m)"))
+        self.nativeRenderCheckBox.setText(_translate("MainWindow", "Рисовать без браузера"))
         self.imgGenButton.setText(_translate("MainWindow", "Сгеренировать блок-схему"))
         self.groupBox_2.setTitle(_translate("MainWindow", "Блок-схема"))
         self.imgSaveButton.setText(_translate("MainWindow", "Сохранить"))
@@ -1,24 +1,11 @@
-import re
+import asyncio, io, re
+import xml.etree.ElementTree as ET
+from typing import Dict, Iterator, List, Set, Tuple
+from xml.sax.saxutils import unescape
 from flowchartron import diagramMaker, gpt
 from PyQt5.QtCore import pyqtSignal
 
-def extract_XML(gptString: str) -> str | None:
-    pattern = """```xml([^`]*)```"""
-    match = re.search(pattern, gptString)
-    if (match == None): return None
-    return match.group(1)
-
-def generate_XML(program_source: str, progress_signal: pyqtSignal) -> str:
-    chat = gpt.DuckChat()
-
-    style_db = diagramMaker.BlockStyleDB("cool_db.db")
-    skel_blocks_desc = diagramMaker.FlowChart.get_behaviour_descs()
-    blocks_desc = style_db.get_decriptions()
-
-    prompt_init = f"""
-For the following code snippet create a flowchart XML in a code block using these blocks:
-{skel_blocks_desc}
-
+FLOWCHART_FORMAT = """
 FlowChart format:
     ```xml
     <flowchart>
@@ -26,7 +13,7 @@ FlowChart format:
     <WhileBlock label="while">
         <BasicBlock label="label"/>
         <BasicBlock label="label"/>
-    <WhileBlock/>
+    </WhileBlock>
     <DecisionBlock label="condition">
         <condition label="label">
             <BasicBlock label="label"/>
@@ -34,45 +21,357 @@ FlowChart format:
     </DecisionBlock>
     </flowchart>
     ```
+"""
+
+CONTAINER_TAGS = ["flowchart", "WhileBlock", "ForBlock", "DecisionBlock", "condition"]
+
+TAG_START = re.compile(r"<\s*(/?)\s*([A-Za-z_][\w.-]*)")
+TAG_END = re.compile(r"\s*(/?)\s*>")
+ATTRIBUTE_NAME = re.compile(r"\s*([A-Za-z_][\w.:-]*)\s*(=?)\s*")
+UNQUOTED_VALUE = re.compile(r"[^\s>]*?(?=\s|/?>|$)")
+# what may follow the real closing quote of a value: the end of the tag or the next attribute
+VALUE_END = re.compile(r"\s*(?:/?\s*>|[A-Za-z_][\w.:-]*\s*=|$)")
+NUMBERED_LINE = re.compile(r"^[ \t]*(\d+)[ \t]*[.):][ \t]*(.*?)[ \t]*$", re.M)
+
+def extract_XML(gptString: str) -> str | None:
+    pattern = """```xml([^`]*)```"""
+    match = re.search(pattern, gptString)
+    if (match != None): return match.group(1)
+
+    # no (or a broken) code block, cut the chart out of the prose around it
+    start = gptString.find("<flowchart")
+    if start == -1: return None
+    end = gptString.rfind("</flowchart>")
+    if end == -1: return gptString[start:]
+    return gptString[start:end + len("</flowchart>")]
+
+def tokenize_XML(xml_string: str) -> Iterator[Tuple[bool, str, Dict[str, str], bool]]:
+    # yields (closing, tag, attributes, self_closing) for every tag, in one pass over the string
+    pos = 0
+    while True:
+        start = xml_string.find("<", pos)
+        if start == -1: return
+
+        match = TAG_START.match(xml_string, start)
+        if match == None:
+            # <?xml ...?>, comments or a stray "<" in a label
+            pos = start + 1
+            continue
+
+        closing = match.group(1) == "/"
+        tag = match.group(2)
+        pos = match.end()
+        attributes: Dict[str, str] = {}
+        self_closing = False
+
+        while pos < len(xml_string):
+            end = TAG_END.match(xml_string, pos)
+            if end != None:
+                self_closing = end.group(1) == "/"
+                pos = end.end()
+                break
+
+            name = ATTRIBUTE_NAME.match(xml_string, pos)
+            if name == None or name.end() == pos:
+                pos += 1
+                continue
+            pos = name.end()
+
+            if name.group(2) == "":
+                attributes[name.group(1)] = ""
+            elif pos < len(xml_string) and xml_string[pos] in "\"'":
+                quote = xml_string[pos]
+                closing_quote = xml_string.find(quote, pos + 1)
+                # quotes inside the label were not escaped, skip to the one that ends the value
+                while closing_quote != -1 and VALUE_END.match(xml_string, closing_quote + 1) == None:
+                    closing_quote = xml_string.find(quote, closing_quote + 1)
+                if closing_quote == -1: closing_quote = len(xml_string)
+                attributes[name.group(1)] = xml_string[pos + 1:closing_quote]
+                pos = closing_quote + 1
+            else:
+                value = UNQUOTED_VALUE.match(xml_string, pos)
+                attributes[name.group(1)] = value.group(0)
+                pos = value.end()
+
+        yield (closing, tag, attributes, self_closing)
+
+def repair_XML(xml_string: str) -> str:
+    # rebuilds the chart from whatever tags the model produced, so the result is always well formed
+    start = xml_string.find("<flowchart")
+    if start != -1: xml_string = xml_string[start:]
+
+    root = ET.Element("flowchart")
+    stack = [root]
+
+    def close(tag: str) -> bool:
+        # closes everything opened after the matching container, stray closers are dropped
+        for depth in range(len(stack) - 1, 0, -1):
+            if stack[depth].tag == tag:
+                del stack[depth:]
+                return True
+        return False
+
+    for closing, tag, attributes, self_closing in tokenize_XML(xml_string):
+        if tag == "flowchart":
+            if closing: break
+            continue
+
+        if closing:
+            close(tag)
+            continue
+
+        # <WhileBlock/> written where </WhileBlock> was meant
+        if self_closing and not attributes and tag in CONTAINER_TAGS and close(tag):
+            continue
+
+        element = ET.SubElement(stack[-1], tag)
+        for name, value in attributes.items():
+            element.set(name, unescape(value, {"&quot;": '"', "&apos;": "'"}))
+        if "label" not in element.attrib: element.set("label", "")
+
+        # a container is only left open when it wasn't self-closed, anything else is a leaf
+        if tag in CONTAINER_TAGS and not self_closing:
+            stack.append(element)
+
+    normalize_containers(root)
+
+    # charts of deeply nested code are too deep for ET.tostring
+    output = io.StringIO()
+    diagramMaker.write_element(output, root)
+    return output.getvalue()
+
+def normalize_containers(root: ET.Element):
+    # FlowChart can't lay out empty containers, conditions outside a DecisionBlock or blocks right inside one
+    stack = [root]
+    while stack:
+        parent = stack.pop()
+
+        children: List[ET.Element] = []
+        stray_branch: ET.Element | None = None
+        pending = list(reversed(parent))
+        while pending:
+            child = pending.pop()
+            if parent.tag == "DecisionBlock" and child.tag != "condition":
+                # consecutive stray blocks become one unlabelled branch
+                if stray_branch is None:
+                    stray_branch = ET.Element("condition", label="")
+                    children.append(stray_branch)
+                stray_branch.append(child)
+                continue
+
+            stray_branch = None
+            if parent.tag != "DecisionBlock" and child.tag == "condition":
+                pending.extend(reversed(child))
+            else:
+                children.append(child)
+        parent[:] = children
+
+        if len(parent) == 0 and parent.tag in ("WhileBlock", "ForBlock", "condition"):
+            ET.SubElement(parent, "ProcessBlock", label="pass")
+        elif len(parent) == 0 and parent.tag == "DecisionBlock":
+            ET.SubElement(ET.SubElement(parent, "condition", label=""), "ProcessBlock", label="pass")
+
+        stack.extend(child for child in parent if child.tag in CONTAINER_TAGS)
+
+def has_complete_XML(gptString: str) -> bool:
+    return re.search("""```xml[^`]*```""", gptString) != None
+
+def ask(chat: gpt.ChatBackend, text_signal: pyqtSignal | None, message: str) -> str:
+    # streams the reply, reports how much of it arrived and stops once the code block is closed
+    on_partial = None if text_signal is None else (lambda text: text_signal.emit(len(text)))
+    return chat.send_message(message, on_partial, has_complete_XML)
+
+def validate_XML(xml_string: str, style_db: diagramMaker.BlockStyleDB) -> bool:
+    # parsing alone accepts charts the layout can't handle, like empty loops or a DecisionBlock without conditions
+    try:
+        flowchart = diagramMaker.FlowChart()
+        flowchart.parse_XML(xml_string, style_db)
+        flowchart.chart_compile_page(style_db)
+    except Exception:
+        return False
+    return True
+
+def base_prompt(program_source: str) -> str:
+    return f"""
+For the following code snippet create a flowchart XML in a code block using these blocks:
+{diagramMaker.FlowChart.get_behaviour_descs()}
+{FLOWCHART_FORMAT}
 Code snippet:
 {program_source}
 """
+
+def decorate_prompt(xmlString: str, blocks_desc: str) -> str:
+    return f"Please replace every BasicBlock in the following flowchart with these:\n{blocks_desc}\nHere is the FlowChart:\n{xmlString}"
+
+def labels_prompt(labels: List[str]) -> str:
+    # only the labels travel to the model, the structure stays here
+    numbered = "\n".join(f"{number}. {label}" for number, label in enumerate(labels, 1))
+    return f"""
+These are the labels of a flowchart's blocks and branches, in reading order.
+Replace every label with a short enough description for flowcharts, while retaining the most context of its functionality in plain language, and translate it to Russian.
+Answer with the numbered list only, one label per line, keeping the numbers:
+{numbered}
+"""
+
+def parse_numbered_list(gptString: str, count: int) -> Dict[int, str]:
+    items: Dict[int, str] = {}
+    for match in NUMBERED_LINE.finditer(gptString):
+        number = int(match.group(1))
+        if 1 <= number <= count and number not in items and match.group(2) != "":
+            items[number] = match.group(2)
+    return items
+
+def parse_flowchart(xmlString: str, style_db: diagramMaker.BlockStyleDB) -> diagramMaker.FlowChart:
+    flowchart = diagramMaker.FlowChart()
+    flowchart.parse_XML(finalize_XML(xmlString, style_db), style_db)
+    return flowchart
+
+def get_labels(flowchart: diagramMaker.FlowChart) -> List[str]:
+    # every distinct label once, repeated ones are rewritten the same way
+    return list(dict.fromkeys(node.label for node in flowchart.get_labelled() if node.label != ""))
+
+def set_labels(flowchart: diagramMaker.FlowChart, labels: List[str], gptString: str) -> str:
+    rewritten = parse_numbered_list(gptString, len(labels))
+    # labels the model skipped stay as they were
+    new_labels = {label: rewritten.get(number, label) for number, label in enumerate(labels, 1)}
+    for node in flowchart.get_labelled():
+        node.label = new_labels.get(node.label, node.label)
+    return flowchart.to_XML()
+
+def combined_prompt(program_source: str, blocks_desc: str) -> str:
+    # everything the pipeline asks for in three round trips, asked at once
+    return f"""
+For the following code snippet create a flowchart XML in a code block.
+Build the structure from these blocks:
+{diagramMaker.FlowChart.get_behaviour_descs()}
+Then write every BasicBlock as one of these blocks instead:
+{blocks_desc}
+Every label must be a short description of what the block does in plain language, written in Russian. Do not put code into labels.
+{FLOWCHART_FORMAT}
+Code snippet:
+{program_source}
+"""
+
+def generate_XML(program_source: str, progress_signal: pyqtSignal, single_prompt: bool = False, text_signal: pyqtSignal | None = None, hedge_delay: float | None = None) -> str:
+    # hedge_delay runs the pipeline through generate_XML_hedged instead, with a second attempt after that many seconds
+    style_db = diagramMaker.BlockStyleDB("cool_db.db")
+    blocks_desc = style_db.get_decriptions()
+
+    if hedge_delay is not None:
+        from flowchartron.async_gpt import make_async_chat
+
+        # the GUI's worker thread has no event loop, the attempts get one and a chat of their own
+        async def generate_hedged() -> str:
+            async with make_async_chat() as chat:
+                return await generate_XML_hedged(chat, style_db, program_source, single_prompt, hedge_delay)
+
+        progress_signal.emit(1)
+        try:
+            return asyncio.run(generate_hedged())
+        finally:
+            progress_signal.emit(0)
+
+    chat = gpt.make_chat()
+    if single_prompt:
+        return generate_XML_single_prompt(chat, style_db, program_source, progress_signal, text_signal)
+
     progress_signal.emit(1)
-    xmlString = chat.send_message(prompt_init)
+    xmlString = ask(chat, text_signal, base_prompt(program_source))
     if (xmlString == None):
         progress_signal.emit(0)
         raise Exception("Не удалось получить базовую диаграмму!")
 
     progress_signal.emit(2)
-    xmlString = chat.send_message(
-            f"Please replace every BasicBlock in the following flowchart with these:\n{blocks_desc}\nHere is the FlowChart:\n{xmlString}"
-            )
+    xmlString = ask(chat, text_signal, decorate_prompt(xmlString, blocks_desc))
     if (xmlString == None):
         progress_signal.emit(0)
         raise Exception("Не удалось получить диаграмму с украшенными блоками!")
         
     progress_signal.emit(3)
-    xmlString = chat.send_message(f"Please replace contents of label=\"something\" with short enough descriptions for flowcharts, while retaining the most context of their functionality in plain language':\n {xmlString}.")
-    if xmlString == None:
+    try:
+        flowchart = parse_flowchart(xmlString, style_db)
+    except Exception:
         progress_signal.emit(0)
-        raise Exception("Не удалось получить переведённую диаграмму!")
+        raise
 
-    progress_signal.emit(4)
-    xmlString = chat.send_message(f"Please translate constents of label=\"something\" to Russian:\n {xmlString}")
-    if xmlString == None:
+    labels = get_labels(flowchart)
+    gptString = ask(chat, text_signal, labels_prompt(labels)) if labels else ""
+    if gptString == None:
         progress_signal.emit(0)
         raise Exception("Не удалось получить переведённую диаграмму!")
+    xmlString = set_labels(flowchart, labels, gptString)
+
+    progress_signal.emit(5)
+    return finish_XML(xmlString, style_db, progress_signal)
+
+def generate_XML_single_prompt(chat: gpt.ChatBackend, style_db: diagramMaker.BlockStyleDB, program_source: str, progress_signal: pyqtSignal, text_signal: pyqtSignal | None = None) -> str:
+    progress_signal.emit(1)
+    xmlString = ask(chat, text_signal, combined_prompt(program_source, style_db.get_decriptions()))
+    if (xmlString == None):
+        progress_signal.emit(0)
+        raise Exception("Не удалось получить диаграмму!")
 
     progress_signal.emit(5)
-    xmlString = chat.send_message(f"Check for unclosed tags in the following xml and correct them. Please return the new xml in a codeblock:\n {xmlString}")
-    if xmlString == None:
+    return finish_XML(xmlString, style_db, progress_signal)
+
+async def generate_XML_async(chat, style_db: diagramMaker.BlockStyleDB, program_source: str, single_prompt: bool = False, use_cache: bool = True) -> str:
+    # same pipeline as generate_XML for an async_gpt.AsyncChatBackend, many of these can run at once
+    blocks_desc = style_db.get_decriptions()
+
+    if single_prompt:
+        xmlString = await chat.send_message(combined_prompt(program_source, blocks_desc), stop_when=has_complete_XML, use_cache=use_cache)
+        return finalize_XML(xmlString, style_db)
+
+    xmlString = await chat.send_message(base_prompt(program_source), stop_when=has_complete_XML, use_cache=use_cache)
+    xmlString = await chat.send_message(decorate_prompt(xmlString, blocks_desc), stop_when=has_complete_XML, use_cache=use_cache)
+
+    flowchart = parse_flowchart(xmlString, style_db)
+    labels = get_labels(flowchart)
+    gptString = await chat.send_message(labels_prompt(labels), use_cache=use_cache) if labels else ""
+    return finalize_XML(set_labels(flowchart, labels, gptString), style_db)
+
+async def generate_XML_hedged(chat, style_db: diagramMaker.BlockStyleDB, program_source: str, single_prompt: bool = False, hedge_delay: float = 30, attempts: int = 2) -> str:
+    # starts another attempt whenever the running ones take longer than hedge_delay (all at once for 0)
+    # or one of them fails, the first valid XML wins and the other attempts are cancelled
+    pending: Set[asyncio.Task] = set()
+    started = 0
+    error: Exception | None = None
+
+    try:
+        while True:
+            if started < attempts:
+                # the repeated attempts skip the cache, it would only hand back the first attempt's replies
+                pending.add(asyncio.create_task(generate_XML_async(chat, style_db, program_source, single_prompt, started == 0)))
+                started += 1
+            if not pending: break
+
+            done, pending = await asyncio.wait(
+                    pending,
+                    timeout=hedge_delay if started < attempts else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                    )
+            for task in done:
+                if task.exception() is None: return task.result()
+                error = task.exception()
+    finally:
+        for task in pending: task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    raise error
+
+def finish_XML(xmlString: str, style_db: diagramMaker.BlockStyleDB, progress_signal: pyqtSignal) -> str:
+    try:
+        return finalize_XML(xmlString, style_db)
+    finally:
         progress_signal.emit(0)
-        raise Exception("Не удалось получить исправленную диаграмму!")
 
+def finalize_XML(xmlString: str, style_db: diagramMaker.BlockStyleDB) -> str:
     XML = extract_XML(xmlString)
     if XML == None:
-        progress_signal.emit(0)
         raise Exception("Не удалось извлечь диаграмму!")
 
-    progress_signal.emit(0)
+    XML = repair_XML(XML)
+    if not validate_XML(XML, style_db):
+        raise Exception("Сгенерированный XML неверного формата!")
+
     return XML
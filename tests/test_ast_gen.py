@@ -0,0 +1,43 @@
+import os, sys
+import xml.etree.ElementTree as ET
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from flowchartron import ast_gen
+from flowchartron.diagramMaker import FlowChart
+from flowchartron.elements_db import BlockStyleDB
+
+@pytest.fixture
+def style_db(tmp_path) -> BlockStyleDB:
+    return BlockStyleDB(str(tmp_path / "styles.db"))
+
+def compile_source(source: str, style_db: BlockStyleDB) -> ET.Element:
+    flowchart = FlowChart()
+    flowchart.parse_XML(ast_gen.generate_XML(source), style_db)
+    return ET.fromstring(flowchart.chart_compile(style_db))
+
+@pytest.mark.parametrize("source", [
+    "def f():\n    while True:\n        return None\n",
+    "def f():\n    while g():\n        print(1)\n        return 2\n",
+    "def f(xs):\n    for x in xs:\n        raise ValueError(x)\n",
+    "def f(xs):\n    for x in xs:\n        return x\n    return None\n",
+    "def f(xs, t):\n    for x in xs:\n        if x == t:\n            return x\n",
+    "def f():\n    while g():\n        if h():\n            raise ValueError()\n        else:\n            return 1\n",
+])
+def test_early_exit_in_loop_ends_the_chart(source, style_db):
+    # every "Конец" is a dead end, the loop around it must not lead anywhere from it
+    drawio = compile_source(source, style_db)
+    cells = list(drawio.iter("mxCell"))
+    terminators = {cell.get("id") for cell in cells if cell.get("value") == "Конец"}
+    assert terminators
+    assert not [cell for cell in cells if cell.get("edge") == "1" and cell.get("source") in terminators]
+
+def test_loop_without_early_exit_loops_back(style_db):
+    drawio = compile_source("def f():\n    while g():\n        print(1)\n", style_db)
+    cells = list(drawio.iter("mxCell"))
+    edges = [cell for cell in cells if cell.get("edge") == "1"]
+    condition = next(cell.get("id") for cell in cells if cell.get("value") == "g()")
+    start_point = next(edge.get("source") for edge in edges if edge.get("target") == condition)
+    # one edge comes in from above, the other one back from the end of the body
+    assert len([edge for edge in edges if edge.get("target") == start_point]) == 2
@@ -0,0 +1,74 @@
+import io, os, sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from flowchartron.diagramMaker import FlowChart
+from flowchartron.elements_db import BlockStyleDB
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(__file__), "data")
+DEPTH = 3000
+
+@pytest.fixture
+def style_db(tmp_path) -> BlockStyleDB:
+    return BlockStyleDB(str(tmp_path / "styles.db"))
+
+def read_data(file_name: str) -> str:
+    with open(os.path.join(DATA_DIRECTORY, file_name), encoding="utf-8", newline="") as F:
+        return F.read()
+
+def deep_XML(depth: int) -> str:
+    # While, For and Decision blocks nested into each other far past the recursion limit
+    opening, closing = [], []
+    for level in range(depth):
+        match level % 3:
+            case 0:
+                opening.append(f'<WhileBlock label="w{level}">')
+                closing.append('</WhileBlock>')
+            case 1:
+                opening.append(f'<ForBlock label="f{level}">')
+                closing.append('</ForBlock>')
+            case 2:
+                opening.append(f'<DecisionBlock label="d{level}"><condition label="Нет"><ProcessBlock label="p{level}"/></condition><condition label="Да">')
+                closing.append('</condition></DecisionBlock>')
+
+    return "<flowchart>" + "".join(opening) + '<ProcessBlock label="leaf"/>' + "".join(reversed(closing)) + "</flowchart>"
+
+def test_deep_nesting_compiles(style_db):
+    assert DEPTH > sys.getrecursionlimit()
+
+    flowchart = FlowChart()
+    flowchart.parse_XML(deep_XML(DEPTH), style_db)
+    drawio = flowchart.chart_compile(style_db)
+    assert 'value="leaf"' in drawio
+    assert f'value="d{DEPTH - 1}"' in drawio
+
+    stream = io.StringIO()
+    flowchart.chart_compile_to(stream, style_db)
+    assert stream.getvalue() == drawio
+
+def test_output_is_byte_identical(style_db):
+    flowchart = FlowChart()
+    flowchart.parse_XML(read_data("sample.xml"), style_db)
+    assert flowchart.chart_compile(style_db) == read_data("sample.drawio")
+
+    stream = io.StringIO()
+    flowchart.chart_compile_to(stream, style_db)
+    assert stream.getvalue() == read_data("sample.drawio")
+
+def test_compile_is_repeatable(style_db):
+    flowchart = FlowChart()
+    flowchart.parse_XML(read_data("sample.xml"), style_db)
+    assert flowchart.chart_compile(style_db) == flowchart.chart_compile(style_db)
+
+def test_deep_chart_round_trips(style_db):
+    flowchart = FlowChart()
+    flowchart.parse_XML(deep_XML(DEPTH), style_db)
+    labelled = flowchart.get_labelled()
+    for node in labelled:
+        node.label = node.label.upper()
+
+    rewritten = FlowChart()
+    rewritten.parse_XML(flowchart.to_XML(), style_db)
+    assert [node.label for node in rewritten.get_labelled()] == [node.label for node in labelled]
+    assert rewritten.chart_compile(style_db) == flowchart.chart_compile(style_db)